@@ -0,0 +1,52 @@
+#!/usr/bin/env python3
+"""
+Micro-benchmark of the classification of the lines printed by a model (see llm-service/outputclassifier.py).
+Feeds the recorded AX-M1 live_print output in data/ through the classifier and, for comparison, through the
+pattern chain which was used before (one regex per marker + a separate regex for the metrics).
+
+Usage: python3 benchmarks/classifier_benchmark.py [--log <file>] [--rounds <n>]
+"""
+import argparse
+import re
+import sys
+import timeit
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "llm-service"))
+from outputclassifier import classify
+
+DEFAULT_LOG = Path(__file__).resolve().parent / "data" / "axm1-live-print.log"
+
+LEGACY_PATTERNS = [re.compile(pattern) for pattern in ["(.*)(Set AXCL device failed)(.*)", "(.*)(lLaMa.Init failed)(.*)",
+    "(.*)(Segmentation fault)(.*)", "(.*)(LLM init start)(.*)", "(.*)(LLM init ok)(.*)", "(.*)(hit eos)(.*)"]]
+LEGACY_AVG_TOKEN_PATTERN = re.compile("(avg)(.*)(token\/s$)")
+
+
+def legacy_classify(line: str):
+    for pattern in LEGACY_PATTERNS:
+        if pattern.match(line) != None:
+            break
+    LEGACY_AVG_TOKEN_PATTERN.search(line)
+
+
+def run(name: str, classifier, lines: list[str], rounds: int):
+    def feed():
+        for line in lines:
+            classifier(line)
+    best = min(timeit.repeat(feed, number=rounds, repeat=5))
+    print(f"{name:<12} {best / rounds / len(lines) * 1e9:8.0f} ns/line")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--log", type=Path, default=DEFAULT_LOG, help="recorded model output, one line per token")
+    parser.add_argument("--rounds", type=int, default=200, help="how often the log is fed per measurement")
+    args = parser.parse_args()
+
+    lines = [line.strip() for line in args.log.read_text().splitlines() if line.strip()]
+    print(f"{len(lines)} lines from {args.log}")
+    run("classify", classify, lines, args.rounds)
+    run("legacy", legacy_classify, lines, args.rounds)
+
+
+if __name__ == "__main__":main()
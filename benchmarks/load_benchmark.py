@@ -0,0 +1,184 @@
+#!/usr/bin/env python3
+"""
+Load test of the llm-service. Sends prompts to /api/generate at several concurrency levels and reports the throughput,
+the latency (p50/p95/p99), the time to the first token, the errors and the cpu time and memory of the llm-service.
+Meant to run against models/fake-model (no npu needed), so changes of the wrapper can be compared on the same machine.
+The results are written to <output>.json (all runs including their configuration) and <output>.csv (one row per run).
+
+Usage: python3 benchmarks/load_benchmark.py --model fake-model [--concurrency 1 2 4 8] [--requests <n>] [--pid <llm-service pid>]
+"""
+import argparse
+import csv
+import http.client
+import json
+import math
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from urllib.parse import urlparse
+
+CLOCK_TICKS = os.sysconf("SC_CLK_TCK")
+RESOURCE_SAMPLE_INTERVAL_SECONDS = 0.2
+CSV_COLUMNS = ["concurrency", "requests", "errors", "wall_seconds", "requests_per_second", "tokens_per_second",
+    "latency_p50", "latency_p95", "latency_p99", "ttft_p50", "ttft_p95", "ttft_p99", "cpu_seconds", "cpu_percent",
+    "peak_rss_mb"]
+
+
+def percentile(values: list[float], percent: float) -> float | None:
+    # Nearest rank, good enough for a few hundred samples
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[max(0, min(len(ordered) - 1, math.ceil(percent / 100 * len(ordered)) - 1))]
+
+
+def send_prompt(url, model: str, prompt: str, stream: bool, timeout: float) -> dict:
+    """
+    Sends one prompt and returns its latency, time to the first token (streamed only), token count and error
+    """
+    result = {"latency": None, "ttft": None, "eval_count": 0, "error": None}
+    start_time = time.monotonic()
+    connection = http.client.HTTPConnection(url.hostname, url.port or 80, timeout=timeout)
+    try:
+        body = json.dumps({"model": model, "prompt": prompt, "stream": stream})
+        connection.request("POST", "/api/generate", body, {"Content-Type": "application/json"})
+        response = connection.getresponse()
+        if response.status != 200:
+            response.read()
+            result["error"] = str(response.status)
+            return result
+        if stream:
+            last_chunk = {}
+            for line in response:
+                if not line.strip():
+                    continue
+                if result["ttft"] is None:
+                    result["ttft"] = time.monotonic() - start_time
+                last_chunk = json.loads(line)
+        else:
+            last_chunk = json.loads(response.read())
+        result["latency"] = time.monotonic() - start_time
+        result["eval_count"] = last_chunk.get("eval_count") or 0
+    except Exception as e:
+        result["error"] = type(e).__name__
+    finally:
+        connection.close()
+    return result
+
+
+# Samples the cpu time and the resident memory of a process (the llm-service) from /proc while a run is going on
+class ResourceSampler:
+
+    def __init__(self, pid: int | None):
+        self.pid = pid
+        self.peak_rss_kb = 0
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self.__sample, daemon=True)
+        self.start_cpu_seconds = None
+
+    def start(self):
+        if self.pid is not None:
+            self.start_cpu_seconds = self.__read_cpu_seconds()
+            self.thread.start()
+
+    def stop(self) -> dict:
+        if self.pid is None:
+            return {"cpu_seconds": None, "peak_rss_mb": None}
+        self.stop_event.set()
+        self.thread.join()
+        return {"cpu_seconds": round(self.__read_cpu_seconds() - self.start_cpu_seconds, 3),
+            "peak_rss_mb": round(self.peak_rss_kb / 1024, 1)}
+
+    def __sample(self):
+        while not self.stop_event.wait(RESOURCE_SAMPLE_INTERVAL_SECONDS):
+            self.peak_rss_kb = max(self.peak_rss_kb, self.__read_rss_kb())
+        self.peak_rss_kb = max(self.peak_rss_kb, self.__read_rss_kb())
+
+    def __read_cpu_seconds(self) -> float:
+        # utime and stime are the 14th and 15th field, the command name in between may contain spaces
+        fields = Path(f"/proc/{self.pid}/stat").read_text().rsplit(")", 1)[1].split()
+        return (int(fields[11]) + int(fields[12])) / CLOCK_TICKS
+
+    def __read_rss_kb(self) -> int:
+        for line in Path(f"/proc/{self.pid}/status").read_text().splitlines():
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1])
+        return 0
+
+
+def run(args, url, concurrency: int) -> dict:
+    sampler = ResourceSampler(args.pid)
+    sampler.start()
+    start_time = time.monotonic()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(executor.map(lambda index: send_prompt(url, args.model, f"{args.prompt} ({index})", args.stream,
+            args.timeout), range(args.requests)))
+    wall_seconds = time.monotonic() - start_time
+    resources = sampler.stop()
+
+    latencies = [result["latency"] for result in results if result["error"] is None]
+    ttfts = [result["ttft"] for result in results if result["ttft"] is not None]
+    errors = {}
+    for result in results:
+        if result["error"] is not None:
+            errors[result["error"]] = errors.get(result["error"], 0) + 1
+    cpu_seconds = resources["cpu_seconds"]
+    return {
+        "concurrency": concurrency,
+        "requests": len(results),
+        "errors": sum(errors.values()),
+        "errors_by_cause": errors,
+        "wall_seconds": round(wall_seconds, 3),
+        "requests_per_second": round(len(latencies) / wall_seconds, 3),
+        "tokens_per_second": round(sum(result["eval_count"] for result in results) / wall_seconds, 3),
+        **{f"latency_p{percent}": percentile(latencies, percent) for percent in (50, 95, 99)},
+        **{f"ttft_p{percent}": percentile(ttfts, percent) for percent in (50, 95, 99)},
+        "cpu_seconds": cpu_seconds,
+        "cpu_percent": round(cpu_seconds / wall_seconds * 100, 1) if cpu_seconds is not None else None,
+        "peak_rss_mb": resources["peak_rss_mb"]
+    }
+
+
+def print_run(result: dict):
+    def format_seconds(value):
+        return f"{value:7.3f}" if value is not None else "      -"
+    print(f"c={result['concurrency']:<3} {result['requests_per_second']:7.2f} req/s {result['tokens_per_second']:8.1f} tok/s"
+        f"  latency p50/p95/p99 {format_seconds(result['latency_p50'])} {format_seconds(result['latency_p95'])} "
+        f"{format_seconds(result['latency_p99'])}  ttft p50/p95/p99 {format_seconds(result['ttft_p50'])} "
+        f"{format_seconds(result['ttft_p95'])} {format_seconds(result['ttft_p99'])}  errors {result['errors']} "
+        f"cpu {result['cpu_percent']}% rss {result['peak_rss_mb']} MB")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", default="http://127.0.0.1:11535", help="base url of the llm-service")
+    parser.add_argument("--model", required=True, help="model name of the descriptor, e.g. the fake-model")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 2, 4, 8], help="parallel clients, one run per level")
+    parser.add_argument("--requests", type=int, default=32, help="prompts per run")
+    parser.add_argument("--prompt", default="Describe the event captured by the camera", help="each prompt gets a number appended, "
+        "so they are neither coalesced nor answered from the cache")
+    parser.add_argument("--no-stream", dest="stream", action="store_false", help="don't stream (no time to first token then)")
+    parser.add_argument("--timeout", type=float, default=600, help="seconds a single prompt may take")
+    parser.add_argument("--pid", type=int, help="pid of the llm-service (uvicorn) for its cpu time and memory")
+    parser.add_argument("--output", type=Path, default=Path("load-benchmark"), help="result files without extension")
+    args = parser.parse_args()
+
+    url = urlparse(args.url)
+    config = {key: str(value) if isinstance(value, Path) else value for key, value in vars(args).items()}
+    runs = []
+    for concurrency in args.concurrency:
+        runs.append(run(args, url, concurrency))
+        print_run(runs[-1])
+
+    args.output.with_suffix(".json").write_text(json.dumps({"config": config, "started_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "runs": runs}, indent=2))
+    with open(args.output.with_suffix(".csv"), "w", newline="") as file:
+        writer = csv.DictWriter(file, fieldnames=CSV_COLUMNS, extrasaction="ignore")
+        writer.writeheader()
+        writer.writerows(runs)
+    print(f"Results written to {args.output.with_suffix('.json')} and {args.output.with_suffix('.csv')}")
+
+
+if __name__ == "__main__":main()
@@ -0,0 +1,95 @@
+import hashlib
+import json
+import time
+from collections import OrderedDict
+
+DEFAULT_MAX_SESSIONS = 32
+DEFAULT_SESSION_TTL_SECONDS = 1800
+# Line which makes the model runtime drop the context of the previous prompts
+DEFAULT_RESET_CMD = "reset"
+# The runtime acknowledges a reset with the end of sequence line, unless it prints a line containing the reset ack
+DEFAULT_RESET_ACK = None
+
+
+# One conversation, identified by its messages (as the client sends them back with the next turn)
+class ChatSession:
+
+    def __init__(self, key: str, turns: int):
+        self.key = key
+        self.turns = turns
+        self.last_used_at = time.time()
+
+
+# Keeps track of the conversations of a model. Chat clients send the whole conversation with every turn. If the model
+# runtime keeps the context of the previous prompts in its kv-cache (context continuation) and a conversation continues
+# exactly the one which is resident in the model, only the new turn needs to be sent. Any other prompt needs a fresh
+# context. The number of sessions is bounded, the least recently used ones are evicted first
+class ChatSessions:
+
+    def __init__(self, context_continuation: bool = False, max_sessions: int = DEFAULT_MAX_SESSIONS,
+        ttl_seconds: float = DEFAULT_SESSION_TTL_SECONDS, reset_cmd: str = DEFAULT_RESET_CMD,
+        reset_ack: str | None = DEFAULT_RESET_ACK):
+        self.context_continuation = context_continuation
+        self.max_sessions = max_sessions
+        self.ttl_seconds = ttl_seconds
+        self.reset_cmd = reset_cmd
+        self.reset_ack = reset_ack
+        # key -> session
+        self.sessions = OrderedDict()
+        # The session whose context is in the model. If None but the context is dirty, it's the one of a single prompt
+        self.resident = None
+        self.context_dirty = False
+
+    @staticmethod
+    def create_key(messages: list[dict]) -> str:
+        # Clients may reformat the messages they send back, whitespace must not break the match
+        normalized = [[message.get("role", ""), " ".join(str(message.get("content", "")).split())] for message in messages]
+        return hashlib.sha256(json.dumps(normalized).encode()).hexdigest()
+
+    def continues_resident(self, messages: list[dict]) -> bool:
+        """
+        Tells whether the given messages are the resident conversation plus a new turn
+        """
+        if not self.context_continuation or self.resident is None or len(messages) < 2:
+            return False
+        return self.create_key(messages[:-1]) == self.resident.key
+
+    def record_answer(self, messages: list[dict] | None, answer: str):
+        """
+        The model answered the given messages (or a single prompt if None), which is now the context in the model
+        """
+        self.context_dirty = True
+        if messages is None:
+            self.resident = None
+            return
+        key = self.create_key(messages + [{"role": "assistant", "content": answer}])
+        session = self.sessions.pop(key, None) or ChatSession(key, 0)
+        session.turns = sum(1 for message in messages if message.get("role") == "user")
+        session.last_used_at = time.time()
+        self.sessions[key] = session
+        self.resident = session
+        self.__evict()
+
+    def lose_context(self):
+        # The model was restarted or the answer broke off, the context is unknown
+        self.resident = None
+        self.context_dirty = True
+
+    def clear_context(self):
+        # Fresh model process or the context was reset
+        self.resident = None
+        self.context_dirty = False
+
+    def get_session_count(self) -> int:
+        return len(self.sessions)
+
+    def __evict(self):
+        expired_before = time.time() - self.ttl_seconds
+        while self.sessions:
+            key, session = next(iter(self.sessions.items()))
+            if len(self.sessions) <= self.max_sessions and session.last_used_at >= expired_before:
+                break
+            del self.sessions[key]
+            if session is self.resident:
+                # Its context is still in the model, but it won't be continued anymore
+                self.resident = None
@@ -0,0 +1,189 @@
+import asyncio
+import logging
+import time
+from collections import deque
+from fastapi import HTTPException
+from llmservice import LlmService, LlmStatus
+from requesttracing import RequestTrace
+
+logger = logging.getLogger("uvicorn.error")
+logger.setLevel(logging.DEBUG)
+
+# Replicas are picked in this order: ready ones, then the ones which are starting, then the stopped ones (they're
+# started on demand). Failed ones only if there is nothing else
+HEALTH_RANKS = {
+    LlmStatus.READY: 0,
+    LlmStatus.ANSWERING: 0,
+    LlmStatus.ANSWERING_DONE: 0,
+    LlmStatus.RESETTING: 0,
+    LlmStatus.WAIT_FOR_TOKENIZER: 1,
+    LlmStatus.STARTING: 1,
+    LlmStatus.INIT: 1,
+    LlmStatus.IDLE: 2,
+    LlmStatus.INIT_FAILED: 3
+}
+UNAVAILABLE_RANK = 4
+# Errors of a replica after which another replica is tried: queue full, queue timeout, crashed or given up
+FAILOVER_STATUS_CODES = (429, 503)
+# Prompts of a batch in flight per replica: one which is answered and the next one queued right behind it
+BATCH_PROMPTS_PER_REPLICA = 2
+
+
+# Dispatches the prompts for a model to its replicas. Each prompt goes to the healthiest replica with the least prompts
+# queued. Among those, a replica which has the conversation of a chat in its context is preferred. A prompt which is
+# identical to one in flight goes to the same replica, so they share one answer (see LlmService.in_flight).
+# If the replica can't take the prompt, the next one is tried
+class LlmRouter:
+
+    def __init__(self, model_name: str, replicas: list[LlmService]):
+        self.model_name = model_name
+        self.replicas = replicas
+        # Replica name -> prompts dispatched to it which are not answered (or streamed) yet. A prompt only shows up in
+        # the scheduler of the replica once it's queued, so prompts arriving at the same time would all go to one replica
+        self.outstanding = {replica.replica_name: 0 for replica in replicas}
+        # Prompt key -> replicas the prompt was dispatched to, until they have taken it. Until then it's not in flight
+        # at the replica, so identical prompts arriving at the same time would go to different replicas
+        self.dispatching = {}
+
+    async def prompt_llm_with_stats(self, prompt: str, deadline_seconds: float | None = None,
+        options: dict | None = None, trace: RequestTrace | None = None) -> dict:
+        return await self.__route(lambda replica, deadline: replica.prompt_llm_with_stats(prompt, deadline, options,
+            trace=trace), deadline_seconds, prompt_key=self.get_primary().create_prompt_key(prompt, options))
+
+    async def prompt_llm_stream(self, prompt: str, deadline_seconds: float | None = None, options: dict | None = None,
+        trace: RequestTrace | None = None):
+        return await self.__route(lambda replica, deadline: replica.prompt_llm_stream(prompt, deadline, options,
+            trace=trace), deadline_seconds, prompt_key=self.get_primary().create_prompt_key(prompt, options))
+
+    async def chat_llm_with_stats(self, messages: list[dict], deadline_seconds: float | None = None,
+        options: dict | None = None, trace: RequestTrace | None = None) -> dict:
+        return await self.__route(lambda replica, deadline: replica.chat_llm_with_stats(messages, deadline, options,
+            trace), deadline_seconds, messages, self.__create_chat_key(messages, options))
+
+    async def chat_llm_stream(self, messages: list[dict], deadline_seconds: float | None = None,
+        options: dict | None = None, trace: RequestTrace | None = None):
+        return await self.__route(lambda replica, deadline: replica.chat_llm_stream(messages, deadline, options, trace),
+            deadline_seconds, messages, self.__create_chat_key(messages, options))
+
+    async def prompt_llm_batch(self, items: list[dict], offset: int = 0):
+        """
+        Answers the prompts of a batch ({"prompt": .., "options": ..} each), starting at the given offset. The next
+        prompts are always queued behind the ones being answered, so the replicas don't idle between the prompts.
+        Yields the result of each prompt in the order of the prompts (so an interrupted batch can be resumed after the
+        last result) and finally the aggregate throughput, along with the failed prompts and the offset to resume
+        from (the first failed prompt). Prompts which are still queued when the batch is cancelled are not sent
+        """
+        start_time = time.monotonic()
+        in_flight = BATCH_PROMPTS_PER_REPLICA * len(self.replicas)
+        pending = deque()
+        next_index = offset
+        answered = eval_count = 0
+        failed = []
+        try:
+            while next_index < len(items) or pending:
+                while next_index < len(items) and len(pending) < in_flight:
+                    pending.append((next_index, asyncio.create_task(self.__prompt_batch_item(items[next_index]))))
+                    next_index += 1
+                index, prompted = pending.popleft()
+                result = await prompted
+                if "error" in result:
+                    failed.append(index)
+                else:
+                    answered += 1
+                    eval_count += result["eval_count"]
+                yield {"index": index, **result}
+        finally:
+            for _, prompted in pending:
+                prompted.cancel()
+        wall_seconds = time.monotonic() - start_time
+        yield {
+            "done": True,
+            "answered": answered,
+            "errors": len(failed),
+            "failed": failed,
+            "next_offset": failed[0] if failed else next_index,
+            "wall_seconds": round(wall_seconds, 3),
+            "prompts_per_second": round((answered + len(failed)) / wall_seconds, 3) if wall_seconds > 0 else 0,
+            "tokens_per_second": round(eval_count / wall_seconds, 3) if wall_seconds > 0 else 0
+        }
+
+    async def __prompt_batch_item(self, item: dict) -> dict:
+        start_time = time.monotonic()
+        try:
+            answer = await self.prompt_llm_with_stats(item["prompt"], options=item.get("options"))
+        except HTTPException as e:
+            return {"error": str(e.detail)}
+        except Exception as e:
+            return {"error": str(e)}
+        answer = {key: value for key, value in answer.items() if key != "done"}
+        eval_seconds = answer["eval_duration"] / 1e9
+        # The time the prompt was queued behind the other prompts of the batch is included
+        answer["seconds"] = round(time.monotonic() - start_time, 3)
+        answer["tokens_per_second"] = round(answer["eval_count"] / eval_seconds, 3) if eval_seconds > 0 else 0
+        return answer
+
+    def pick(self, messages: list[dict] | None = None, tried: list[LlmService] = ()) -> LlmService:
+        """
+        Returns the replica which should answer the next prompt
+        """
+        candidates = [replica for replica in self.replicas if replica not in tried]
+        return min(candidates, key=lambda replica: (self.__get_health_rank(replica), self.__get_load(replica),
+            not (messages and replica.chat_sessions.continues_resident(messages)), replica.last_used_at))
+
+    def get_primary(self) -> LlmService:
+        return self.replicas[0]
+
+    async def __route(self, send_prompt, deadline_seconds: float | None = None, messages: list[dict] | None = None,
+        prompt_key: str | None = None):
+        start_time = time.monotonic()
+        tried = []
+        while True:
+            replica = self.__find_in_flight(prompt_key, tried) or self.pick(messages, tried)
+            tried.append(replica)
+            # The deadline of the client is for the whole prompt, not per replica. Without one, the replica queues the
+            # prompt up to its queue timeout, but only the deadline of the client limits the prefill of the prompt
+            elapsed = time.monotonic() - start_time
+            deadline = max(deadline_seconds - elapsed, 0) if deadline_seconds is not None else None
+            remaining = (deadline_seconds if deadline_seconds is not None else replica.scheduler.queue_timeout) - elapsed
+            self.outstanding[replica.replica_name] += 1
+            if prompt_key is not None:
+                self.dispatching.setdefault(prompt_key, []).append(replica)
+            try:
+                return await send_prompt(replica, deadline)
+            except HTTPException as e:
+                if e.status_code not in FAILOVER_STATUS_CODES or len(tried) == len(self.replicas) or remaining <= 0:
+                    raise
+                logger.warning(f"Replica '{replica.replica_name}' can't take the prompt ({e.detail}), trying another one")
+            finally:
+                self.outstanding[replica.replica_name] -= 1
+                self.__dispatched(prompt_key, replica)
+
+    def __find_in_flight(self, prompt_key: str | None, tried: list[LlmService]) -> LlmService | None:
+        # The replica which is about to take or already answers an identical prompt
+        if prompt_key is None:
+            return None
+        candidates = self.dispatching.get(prompt_key, []) + [replica for replica in self.replicas if prompt_key in replica.in_flight]
+        return next((replica for replica in candidates if replica not in tried), None)
+
+    def __dispatched(self, prompt_key: str | None, replica: LlmService):
+        if prompt_key is None:
+            return
+        replicas = self.dispatching[prompt_key]
+        replicas.remove(replica)
+        if not replicas:
+            del self.dispatching[prompt_key]
+
+    def __create_chat_key(self, messages: list[dict], options: dict | None) -> str | None:
+        # Invalid conversations are rejected by the replica
+        try:
+            return self.get_primary().create_prompt_key(self.get_primary().render_chat(messages), options)
+        except HTTPException:
+            return None
+
+    def __get_load(self, replica: LlmService) -> int:
+        return max(replica.scheduler.get_load(), self.outstanding[replica.replica_name])
+
+    def __get_health_rank(self, replica: LlmService) -> int:
+        if replica.is_unavailable():
+            return UNAVAILABLE_RANK
+        return HEALTH_RANKS[replica.get_status()]
@@ -1,15 +1,23 @@
-import io
+import asyncio
 import logging
+import math
+import os
 import re
 import requests
-import subprocess
 import time
 import threading
+from collections import deque
 from enum import Enum
 from fastapi import HTTPException
-from queue import Queue
-from time import sleep
+from chatsessions import ChatSessions
 from metrics import Metrics
+from outputclassifier import LlmOutput, LlmOutputType, classify
+from promptpipeline import PromptPipeline
+from responsecache import ResponseCache
+from responsesink import ResponseSink
+from tokencounter import TokenCounter
+from requestscheduler import DEFAULT_MAX_QUEUE_DEPTH, DEFAULT_QUEUE_TIME_OUT_SECONDS, RequestScheduler
+from requesttracing import RequestTrace
 from tokenizerservice import TokenizerStatus
 
 class LlmStatus(Enum):
@@ -21,49 +29,91 @@ class LlmStatus(Enum):
     ANSWERING = 6
     ANSWERING_DONE = 7
     INIT_FAILED = 8
+    # The context of the model is reset before the next prompt
+    RESETTING = 9
 
 logger = logging.getLogger("uvicorn.error")
 logger.setLevel(logging.DEBUG)
 
 # wait max 10 minutes
 PROMPT_TIME_OUT_SECONDS = 500
-
-INIT_START_PATTERN = re.compile("(.*)(LLM init start)(.*)")
-INIT_OK_PATTERN = re.compile("(.*)(LLM init ok)(.*)")
-SET_AXCL_DEVICE_FAILED_PATTERN = re.compile("(.*)(Set AXCL device failed)(.*)")
-INIT_FAILED_PATTERN = re.compile("(.*)(lLaMa.Init failed)(.*)")
-SEG_FAULT_PATTERN = re.compile("(.*)(Segmentation fault)(.*)")
+READINESS_TIME_OUT_SECONDS = 300
+# Time the model gets to exit after being asked to quit, before it's killed
+STOP_TIME_OUT_SECONDS = 10
+# Time the model gets to acknowledge a context reset, before the next prompt is sent anyway
+RESET_TIME_OUT_SECONDS = 10
+# A crashed model is restarted after 1, 2, 4.. seconds, but at most after that many seconds
+RESTART_BACKOFF_BASE_SECONDS = 1
+RESTART_BACKOFF_MAX_SECONDS = 60
+# After that many restarts in a row, the model is given up. Prompts are rejected until the max. backoff has passed,
+# then the next prompt starts the model again
+MAX_RESTARTS = 5
+# A model which was up for that long before it crashed is considered stable, so its restarts start from scratch
+RESTART_RESET_SECONDS = 300
+# Status transitions which make up the startup timeline of a model
+STARTUP_PHASES = (LlmStatus.WAIT_FOR_TOKENIZER, LlmStatus.STARTING, LlmStatus.INIT, LlmStatus.READY, LlmStatus.INIT_FAILED)
+# Max. length of one line printed by the model
+MAX_LINE_BYTES = 1024 * 1024
+# Number of status transitions kept per model, the oldest ones are dropped first. A prompt makes about four of them
+STATUS_HISTORY_SIZE = 1000
+# Statuses in which the model holds the npu for a prompt, see get_utilisation
+BUSY_STATUSES = (LlmStatus.ANSWERING, LlmStatus.ANSWERING_DONE, LlmStatus.RESETTING)
+
+# The model did not evaluate anything for an answer from the response cache
+CACHED_ANSWER_STATS = {"done": True, "total_duration": 0, "prompt_eval_count": 0, "prompt_eval_duration": 0, "eval_count": 0,
+    "eval_duration": 0}
+
+THINK_START = "<think>"
 THINK_PATTERN = re.compile("(<\/think>(.*)$)")
-# indicating that the model is done thinking and starts answering (answer may include thinking)
-HIT_EOS_PATTERN = re.compile("(.*)(hit eos)(.*)")
 
 TOKENIZER_STATUS_API = "http://{0}:8101/status"
 TOKENIZER_START_API = "http://{0}:8101/start_tokenizer"
+TOKENIZER_TIME_OUT_SECONDS = 300
+TOKENIZER_REQUEST_TIME_OUT_SECONDS = 10
+# Each long-poll waits that long for the tokenizer to become ready
+TOKENIZER_LONG_POLL_SECONDS = 30
+# Pooled connections to the tokenizer-service
+tokenizer_session = requests.Session()
 
 class LlmService:
 
     def __init__(self, model_name, run_cmd: str, model_path: str, tokenizer_ip: str, tokenizer_py: str, 
-        tokenizer_path: str, tokenizer_port: int, include_thinking: str):
-
-        self.ready_event = threading.Event()
-        self.prompt_answered_event = threading.Event()
-        self.llm_response_buffer = io.StringIO()
+        tokenizer_path: str, tokenizer_port: int, include_thinking: str, max_queue_depth: int = DEFAULT_MAX_QUEUE_DEPTH,
+        queue_timeout: float = DEFAULT_QUEUE_TIME_OUT_SECONDS, response_cache: ResponseCache | None = None,
+        chat_sessions: ChatSessions | None = None, replica_name: str | None = None, device: str | None = None,
+        prompt_pipeline: PromptPipeline | None = None):
+
+        self.ready_event = asyncio.Event()
+        self.reset_done = asyncio.Event()
+        # Sink of the prompt which is currently answered
+        self.active_sink = None
         self.process = None
 
-        self.status_history = []
+        # Most recent status transitions: {status, timestamp, duration} (the duration is None for the current status)
+        self.status_history = deque(maxlen=STATUS_HISTORY_SIZE)
+        # Phase -> seconds since the model start was requested
+        self.startup_timeline = {}
+        self.startup_started_at = None
         self.status = None
         self.status_lock = threading.Lock()
+        # Status name -> total seconds spent in it (without the current one)
+        self.status_durations = {}
+        self.status_since = time.monotonic()
         self.__change_status(LlmStatus.IDLE)
 
         # Create & prepare metrics
-        self.metrics = Metrics()
+        # A model may run in several replicas, each with its own process and tokenizer (registered under its name)
+        self.replica_name = replica_name or model_name
+        self.metrics = Metrics(model_name, self.replica_name)
+        self.metrics.add_collector(self.__collect_metrics)
 
-        self.output_queue = Queue()
-        self.output_listeners = []  # callables that receive each line
+        self.output_listeners = []  # callables that receive each classified line
         self.output_listeners.append(self.metrics.process_llm_output)
         self.output_listeners.append(self.__process_llm_output)
 
         self.model_name = model_name
+        # AXCL device the model runs on, passed to the run_cmd as AXCL_DEVICE
+        self.device = device
         self.run_cmd = run_cmd
         self.model_path = model_path
         self.include_thinking = include_thinking
@@ -71,76 +121,574 @@ class LlmService:
         self.tokenizer_port = tokenizer_port
         self.tokenizer_py = tokenizer_py
         self.tokenizer_path = tokenizer_path
+        self.token_counter = TokenCounter(tokenizer_ip, tokenizer_port)
+        self.scheduler = RequestScheduler(self.replica_name, max_queue_depth, queue_timeout)
+        self.reader_tasks = []
+        self.response_cache = response_cache
+        self.chat_sessions = chat_sessions or ChatSessions()
+        # Turns prompts into one line for the model (template, system prompt, token budget)
+        self.prompt_pipeline = prompt_pipeline or PromptPipeline()
+        # Prompt key -> sink of the prompt in flight. Identical prompts join it instead of being answered again
+        self.in_flight = {}
+        # Starts the model on demand (e.g. when it was stopped because it was idle). If not set, the model is just started
+        self.lifecycle_manager = None
+        self.last_used_at = time.monotonic()
+
+        # Supervision of the model process, see __supervise
+        self.supervisor_task = None
+        self.restart_count = 0
+        self.consecutive_restarts = 0
+        self.up_since = None
+        self.down_since = None
+        self.unavailable_until = 0
+        # Set as soon as the model is given up, so prompts waiting for readiness don't wait in vain
+        self.unavailable_event = asyncio.Event()
 
     # ---------------------------------------------
     #               PROMPT HANDLER
     # ---------------------------------------------
-    def prompt_llm(self, prompt: str) -> str:
-        if self.get_status() != LlmStatus.READY:
-            raise HTTPException(status_code=500, detail=f"Model not ready! Model status: {self.get_status()}")
-        start_time = time.monotonic()
-
-        # Send prompt to model
-        logger.info(f"Sending prompt '{prompt}'")
-        self.__change_status(LlmStatus.ANSWERING)
-        self.process.stdin.write(prompt + "\n")
-        self.process.stdin.flush()
+    async def prompt_llm(self, prompt: str, deadline_seconds: float | None = None, options: dict | None = None,
+        trace: RequestTrace | None = None) -> str:
+        """
+        Queues the prompt until the model is free and ready, then waits for the model's answer.
+        The deadline limits how long the prompt may wait in the queue. If the answer is cached, there is no wait at all.
+        If an identical prompt is already in flight, its answer is shared. The stages of the prompt are recorded
+        into the trace (if given)
+        """
+        answer = await self.prompt_llm_with_stats(prompt, deadline_seconds, options, trace=trace)
+        return answer["response"]
+
+    async def prompt_llm_with_stats(self, prompt: str, deadline_seconds: float | None = None,
+        options: dict | None = None, messages: list[dict] | None = None, trace: RequestTrace | None = None) -> dict:
+        """
+        Like prompt_llm, but returns the answer along with its Ollama-like stats (token counts and durations).
+        If the prompt is a rendered conversation, the messages allow to send only the new turn (see ChatSessions)
+        """
+        self.metrics.record_request()
+        prompt_key = self.create_prompt_key(prompt, options)
+        cached_response = self.__get_cached_response(prompt, prompt_key, trace)
+        if cached_response is not None:
+            return {"response": cached_response, **CACHED_ANSWER_STATS}
+        prompt = await self.__prepare_prompt(prompt, deadline_seconds, messages)
+        sink = await self.__join_or_send_prompt(prompt, prompt_key, deadline_seconds, messages, trace)
 
         # Wait for model to deliver final response
         logger.debug("Prompt sent. Waiting for answer")
-        if not self.prompt_answered_event.wait(timeout=PROMPT_TIME_OUT_SECONDS):
-            raise TimeoutError(f"{self.model_name} did not answer in time")
-        self.prompt_answered_event.clear()
-        response = self.llm_response_buffer.getvalue()
+        if not await sink.wait(timeout=PROMPT_TIME_OUT_SECONDS):
+            self.__abandon_sink(sink)
+            self.metrics.record_error("answer_timeout")
+            raise TimeoutError(f"{self.replica_name} did not answer in time")
+        if sink.error is not None:
+            raise sink.error
+        response = sink.getvalue()
         logger.info(f"Done, got response: {response}")
 
-        # Write metrics
-        self.metrics.write(self.model_name, time.monotonic() - start_time, response)
-
         # Clean up and return response
-        if self.include_thinking.lower() == 'false':
+        return {"response": self.__remove_thinking(response), **await self.__get_stats(sink)}
+
+    async def prompt_llm_stream(self, prompt: str, deadline_seconds: float | None = None, options: dict | None = None,
+        messages: list[dict] | None = None, trace: RequestTrace | None = None):
+        """
+        Queues the prompt like prompt_llm, sends it to the model and returns an async generator which yields Ollama-like
+        chunks as soon as the model prints them. The last chunk has 'done' set and carries the timing stats of the
+        prompt (in nanoseconds)
+        """
+        self.metrics.record_request()
+        prompt_key = self.create_prompt_key(prompt, options)
+        cached_response = self.__get_cached_response(prompt, prompt_key, trace)
+        if cached_response is not None:
+            return self.__stream_cached_answer(cached_response)
+        prompt = await self.__prepare_prompt(prompt, deadline_seconds, messages)
+        sink = await self.__join_or_send_prompt(prompt, prompt_key, deadline_seconds, messages, trace)
+        return self.__stream_answer(sink)
+
+    async def chat_llm_with_stats(self, messages: list[dict], deadline_seconds: float | None = None,
+        options: dict | None = None, trace: RequestTrace | None = None) -> dict:
+        """
+        Answers the last message of the conversation, like prompt_llm_with_stats does
+        """
+        return await self.prompt_llm_with_stats(self.render_chat(messages), deadline_seconds, options, messages, trace)
+
+    async def chat_llm_stream(self, messages: list[dict], deadline_seconds: float | None = None,
+        options: dict | None = None, trace: RequestTrace | None = None):
+        """
+        Answers the last message of the conversation, like prompt_llm_stream does
+        """
+        return await self.prompt_llm_stream(self.render_chat(messages), deadline_seconds, options, messages, trace)
+
+    def create_prompt_key(self, prompt: str, options: dict | None = None) -> str:
+        """
+        Identifies the answer of the prompt: identical prompts share it while it's in flight (or cached)
+        """
+        return ResponseCache.create_key(self.model_name, prompt, options, self.include_thinking)
+
+    def render_chat(self, messages: list[dict]) -> str:
+        """
+        Renders the whole conversation as one prompt line, for a model which has none of it in its context
+        """
+        if not messages or messages[-1].get("role") != "user":
+            raise HTTPException(status_code=400, detail="The last message of a chat has to be one of the user")
+        if len(messages) == 1:
+            return self.__to_line(messages[0])
+        return " ".join(f"{message.get('role', 'user')}: {self.__to_line(message)}" for message in messages)
+
+    def __to_line(self, message: dict) -> str:
+        # The model reads one prompt per line
+        return " ".join(str(message.get("content", "")).split())
+
+    async def __prepare_prompt(self, prompt: str, deadline_seconds: float | None, messages: list[dict] | None) -> str:
+        # Before the prompt is queued, so a prompt which would take too long to prefill does not wait in vain
+        try:
+            if messages is not None and self.chat_sessions.continues_resident(messages):
+                # Only the new turn is sent (see __prepare_context), so only its prefill counts. A model which
+                # continues conversations has no template or token budget (see ModelHelper)
+                await self.prompt_pipeline.prepare(self.__to_line(messages[-1]), self.token_counter, deadline_seconds)
+                return prompt
+            prompt_line, truncated = await self.prompt_pipeline.prepare(prompt, self.token_counter, deadline_seconds)
+        except HTTPException:
+            self.metrics.record_error("prompt_too_large")
+            raise
+        if truncated:
+            self.metrics.record_prompt_truncated()
+        return prompt_line
+
+    def __get_cached_response(self, prompt: str, prompt_key: str, trace: RequestTrace | None) -> str | None:
+        if self.response_cache is None:
+            return None
+        cached_response = self.response_cache.get(prompt_key)
+        self.metrics.record_cache_lookup(cached_response is not None)
+        if cached_response is not None:
+            logger.info(f"Got cached response for prompt '{prompt}'")
+            if trace is not None:
+                trace.attach(self.replica_name)
+                trace.cached = True
+        return cached_response
+
+    async def __join_or_send_prompt(self, prompt: str, prompt_key: str, deadline_seconds: float | None,
+        messages: list[dict] | None, trace: RequestTrace | None) -> ResponseSink:
+        sink = self.in_flight.get(prompt_key)
+        if sink is not None:
+            logger.info(f"Prompt '{prompt}' joins the identical prompt in flight")
+            self.metrics.record_coalesced_prompt()
+        else:
+            sink = ResponseSink()
+            sink.prompt = prompt
+            sink.messages = messages
+            sink.flight_key = prompt_key
+            if self.response_cache is not None:
+                sink.cache_key = prompt_key
+            self.in_flight[prompt_key] = sink
+            # Sending the prompt must not depend on the client which happened to be first, others may be waiting too
+            sink.sent = asyncio.create_task(self.__queue_and_send_prompt(prompt, sink, deadline_seconds))
+            sink.sent.add_done_callback(lambda sent: sent.cancelled() or sent.exception())
+        if trace is not None:
+            trace.attach(self.replica_name, sink.timings)
+            sink.request_ids.append(trace.request_id)
+        sink.waiters += 1
+        try:
+            await asyncio.shield(sink.sent)
+        except asyncio.CancelledError:
+            # Nobody waits for the answer anymore (e.g. a cancelled batch), so it gives up its place in the queue.
+            # Once it's the turn of the prompt, it's answered anyway
+            if sink.waiters == 1 and "queue" not in sink.timings:
+                sink.sent.cancel()
+            raise
+        finally:
+            sink.waiters -= 1
+        return sink
+
+    async def __queue_and_send_prompt(self, prompt: str, sink: ResponseSink, deadline_seconds: float | None):
+        try:
+            sink.queue_wait = sink.timings["queue"] = await self.scheduler.acquire(deadline_seconds)
+        except BaseException as e:
+            # Rejected (queue full or no turn within the deadline), so there's no queue slot to release
+            self.__land(sink)
+            if not isinstance(e, asyncio.CancelledError):
+                self.metrics.record_error(self.__get_error_cause(e))
+                self.metrics.record_queue_wait(time.monotonic() - sink.created_time)
+            raise
+        try:
+            # It's our turn, so any other prompt is answered. But the model may not be running or still be starting up
+            self.last_used_at = time.monotonic()
+            if self.get_status() == LlmStatus.IDLE:
+                self.__raise_if_unavailable()
+                start_time = time.monotonic()
+                await self.__start_on_demand()
+                sink.timings["model_start"] = time.monotonic() - start_time
+                # The model start includes waiting for the tokenizer
+                sink.timings["tokenizer_start"] = self.startup_timeline.get(LlmStatus.STARTING.name, 0)
+            start_time = time.monotonic()
+            await self.await_readiness(timeout=READINESS_TIME_OUT_SECONDS)
+            sink.timings["readiness"] = time.monotonic() - start_time
+            if self.get_status() != LlmStatus.READY:
+                raise HTTPException(status_code=500, detail=f"Model not ready! Model status: {self.get_status()}")
+            prompt = sink.prompt_line = await self.__prepare_context(sink)
+            logger.info(f"Sending prompt '{prompt}' (requests: {', '.join(sink.request_ids) or '-'})")
+            sink.start_time = time.monotonic()
+            self.active_sink = sink
+            # The model prints the avg token/s of each answer, the one of the previous answer must not be taken for this one
+            self.metrics.avg_token_per_second = None
+            self.__change_status(LlmStatus.ANSWERING)
+            self.process.stdin.write((prompt + "\n").encode())
+            await self.process.stdin.drain()
+            sink.sent_time = time.monotonic()
+            sink.timings["stdin_write"] = sink.sent_time - sink.start_time
+        except BaseException as e:
+            self.__land(sink)
+            if not self.__abandon_sink(sink):
+                self.scheduler.release()
+            if not isinstance(e, asyncio.CancelledError):
+                self.metrics.record_error(self.__get_error_cause(e))
+            raise
+
+    async def __prepare_context(self, sink: ResponseSink) -> str:
+        # Returns what to send for the prompt of the sink. Only called while the model is ours and ready
+        chat_sessions = self.chat_sessions
+        if not chat_sessions.context_continuation:
+            return sink.prompt
+        if sink.messages is not None and chat_sessions.continues_resident(sink.messages):
+            logger.info(f"Prompt continues the conversation in the context of model '{self.replica_name}', sending the new turn only")
+            return self.__to_line(sink.messages[-1])
+        if chat_sessions.context_dirty:
+            await self.__reset_context()
+        return sink.prompt
+
+    async def __reset_context(self):
+        # The model acknowledges the reset with output of its own, which must not end up in the answer of the next
+        # prompt (an end of sequence would even end it). So the output is dropped until the acknowledgment
+        self.reset_done.clear()
+        self.__change_status(LlmStatus.RESETTING)
+        try:
+            self.process.stdin.write((self.chat_sessions.reset_cmd + "\n").encode())
+            await self.process.stdin.drain()
+            await asyncio.wait_for(self.reset_done.wait(), timeout=RESET_TIME_OUT_SECONDS)
+        except asyncio.TimeoutError:
+            logger.warning(f"Model '{self.replica_name}' did not acknowledge the context reset within {RESET_TIME_OUT_SECONDS}s")
+        finally:
+            # Unless the model crashed meanwhile
+            if self.get_status() == LlmStatus.RESETTING:
+                self.__change_status(LlmStatus.READY)
+        self.chat_sessions.clear_context()
+        if self.get_status() != LlmStatus.READY:
+            raise HTTPException(status_code=500, detail=f"Model not ready after the context reset! Model status: {self.get_status()}")
+
+    def __get_error_cause(self, error: BaseException) -> str:
+        if isinstance(error, HTTPException):
+            return {429: "queue_full", 503: "unavailable"}.get(error.status_code, "not_ready")
+        if isinstance(error, TimeoutError):
+            return "readiness_timeout"
+        return "send_failed"
+
+    def __complete_answer(self):
+        # Called by the llm output handler as soon as the model is done. The model is free for the next prompt,
+        # even if the client of this prompt is still reading the answer (or has gone away)
+        sink = self.active_sink
+        self.active_sink = None
+        if sink is None:
+            # The prompt was abandoned (e.g. it timed out) while the model kept answering. Its queue slot is already
+            # released, but only now the model is free for the next prompt
+            self.last_used_at = time.monotonic()
+            self.__change_status(LlmStatus.READY)
+            return
+        self.__land(sink)
+        self.last_used_at = time.monotonic()
+        sink.close()
+        # Prefill until the first output of the model, decode until it's done
+        first_line_time = sink.first_line_time or sink.end_time
+        sink.timings["prefill"] = first_line_time - (sink.sent_time or sink.start_time)
+        sink.timings["decode"] = sink.end_time - first_line_time
+        logger.info(f"Model '{self.replica_name}' has answered (requests: {', '.join(sink.request_ids) or '-'})")
+        if sink.cache_key is not None and not sink.truncated:
+            self.response_cache.put(sink.cache_key, self.__remove_thinking(sink.getvalue()))
+        if sink.truncated:
+            self.chat_sessions.lose_context()
+        else:
+            self.chat_sessions.record_answer(sink.messages, self.__remove_thinking(sink.getvalue()))
+        sink.avg_token_per_second = self.metrics.avg_token_per_second
+        sink.counted = asyncio.create_task(self.__count_tokens(sink))
+        self.__change_status(LlmStatus.READY)
+        self.scheduler.release()
+
+    async def __count_tokens(self, sink: ResponseSink):
+        # Asks the tokenizer after the model is released, so counting does not delay the next prompt.
+        # If the tokenizer can't be asked, each line is taken as one token (which it is in live_print mode)
+        start_time = time.monotonic()
+        sink.prompt_eval_count = await self.token_counter.count(sink.prompt_line) or 0
+        if not sink.truncated:
+            self.prompt_pipeline.record_prefill(sink.prompt_eval_count, sink.timings["prefill"])
+        # A truncated answer is incomplete, so the tokenizer can't count it
+        eval_count = None if sink.truncated else await self.token_counter.count(sink.getvalue(), cache=False)
+        sink.eval_count = eval_count if eval_count is not None else sink.line_count
+        sink.timings["token_count"] = time.monotonic() - start_time
+        first_line_time = sink.first_line_time or sink.end_time
+        self.metrics.record_answer(sink.prompt_eval_count, sink.eval_count, sink.avg_token_per_second, sink.queue_wait,
+            first_line_time - sink.start_time, sink.end_time - first_line_time, sink.end_time - sink.created_time)
+
+    async def __get_stats(self, sink: ResponseSink) -> dict:
+        await asyncio.shield(sink.counted)
+        first_line_time = sink.first_line_time or sink.end_time
+        return {
+            "done": True,
+            "total_duration": int((sink.end_time - sink.start_time) * 1e9),
+            "prompt_eval_count": sink.prompt_eval_count,
+            "prompt_eval_duration": int((first_line_time - sink.start_time) * 1e9),
+            "eval_count": sink.eval_count,
+            "eval_duration": int((sink.end_time - first_line_time) * 1e9)
+        }
+
+    def __abandon_sink(self, sink: ResponseSink) -> bool:
+        # From now on, late output of the model can't end up in the answer of the next prompt
+        if self.active_sink is not sink:
+            return False
+        self.__land(sink)
+        self.active_sink = None
+        self.chat_sessions.lose_context()
+        self.scheduler.release()
+        return True
+
+    def __land(self, sink: ResponseSink):
+        # The prompt is no longer in flight, identical prompts from now on need to be answered again
+        if self.in_flight.get(sink.flight_key) is sink:
+            del self.in_flight[sink.flight_key]
+
+    async def __stream_answer(self, sink: ResponseSink):
+        # If the thinking is hidden and the answer starts with thinking, hold back everything until the end of thinking.
+        # If there is no end, the held back lines are flushed when the model has answered, exactly like prompt_llm does
+        awaiting_first_line = self.__hide_thinking()
+        held_back = None
+        try:
+            async for line in sink.lines(timeout=PROMPT_TIME_OUT_SECONDS):
+                if awaiting_first_line and line.strip():
+                    awaiting_first_line = False
+                    if line.lstrip().startswith(THINK_START):
+                        held_back = []
+                if held_back is not None:
+                    match = THINK_PATTERN.search(line)
+                    if match:
+                        held_back = None
+                        line = match.group(2).strip()
+                    else:
+                        held_back.append(line)
+                        continue
+                if line:
+                    yield {"response": line, "done": False}
+        except TimeoutError:
+            self.__abandon_sink(sink)
+            self.metrics.record_error("answer_timeout")
+            raise TimeoutError(f"{self.replica_name} did not answer in time")
+        if held_back:
+            yield {"response": "".join(held_back), "done": False}
+        yield {"response": "", **await self.__get_stats(sink)}
+
+    async def __stream_cached_answer(self, response: str):
+        yield {"response": response, "done": False}
+        yield {"response": "", **CACHED_ANSWER_STATS}
+
+    def __remove_thinking(self, response: str) -> str:
+        if self.__hide_thinking():
             match = THINK_PATTERN.search(response)
             if match:
                 response = match.group(2).strip()
-
-        # Reset status
-        self.__change_status(LlmStatus.READY)
         return response
 
+    def __hide_thinking(self) -> bool:
+        return self.include_thinking.lower() == 'false'
+
     # ---------------------------------------------
     #               MODEL STARTUP
     # ---------------------------------------------
-    def start_model(self):
-        # Start Tokenizer
-        logger.info(f"Model start '{self.model_name}' requested")
+    async def start_model(self):
+        self.unavailable_event.clear()
+        await self.start_tokenizer()
+        await self.start_model_process()
+
+    async def __start_on_demand(self):
+        logger.info(f"Prompt requested, but model '{self.replica_name}' is not started yet -> starting model")
+        if self.lifecycle_manager is not None:
+            await self.lifecycle_manager.ensure_model_started(self)
+        else:
+            await self.start_model()
+
+    async def start_tokenizer(self):
+        """
+        First part of the model start: starts the tokenizer and waits until it's ready. This does not use the npu,
+        so it may overlap with the start of other models
+        """
+        logger.info(f"Model start '{self.replica_name}' requested")
+        self.startup_timeline = {}
+        self.startup_started_at = time.monotonic()
         self.__change_status(LlmStatus.WAIT_FOR_TOKENIZER)
-        self.__start_tokenizer_and_await_readiness()
-        self.__change_status(LlmStatus.STARTING)
+        await self.__start_tokenizer_and_await_readiness()
 
-        # Now start Model
+    async def start_model_process(self):
+        """
+        Second part of the model start: starts the model, which then initializes itself on the npu
+        """
+        self.__change_status(LlmStatus.STARTING)
         logger.info(f"Starting model {self.model_path}/{self.run_cmd} listening at {self.tokenizer_ip}:{self.tokenizer_port}")
-        self.process = subprocess.Popen(
-            [self.run_cmd, str(self.tokenizer_port)], cwd=self.model_path,
-            stdin=subprocess.PIPE,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            text=True,
-            bufsize=1
+        self.process = await asyncio.create_subprocess_exec(
+            self.run_cmd, str(self.tokenizer_port), cwd=self.model_path,
+            stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+            limit=MAX_LINE_BYTES,
+            env={**os.environ, "AXCL_DEVICE": self.device} if self.device is not None else None
         )
-        logger.info(f"Model started, wait for readiness. Process {self.process}..")
+        logger.info(f"Model started, wait for readiness. Process {self.process.pid}..")
+        self.chat_sessions.clear_context()
 
-        # Handle stdout and stderr in threads
-        threading.Thread(target=self.__read_from_llm_stdout, args=(self.process.stdout, "STDOUT",), daemon=True).start()
-        threading.Thread(target=self.__read_from_llm_stdout, args=(self.process.stderr, "STDERR",), daemon=True).start()
+        # Handle stdout and stderr in tasks
+        self.reader_tasks = [
+            asyncio.create_task(self.__read_from_llm_stdout(self.process.stdout, "STDOUT")),
+            asyncio.create_task(self.__read_from_llm_stdout(self.process.stderr, "STDERR"))
+        ]
+        self.supervisor_task = asyncio.create_task(self.__supervise(self.process, self.reader_tasks))
+
+    # ---------------------------------------------
+    #               MODEL SUPERVISION
+    # ---------------------------------------------
+    async def __supervise(self, process: asyncio.subprocess.Process, reader_tasks: list):
+        """
+        Watches the model process until it exits. Since an intended stop cancels the supervision first, any exit
+        seen here is a crash: the prompt in flight fails right away and the model is restarted with an exponential
+        backoff. Queued prompts keep waiting for the restarted model, unless it's given up
+        """
+        # The readers hit EOF as soon as the process is gone. asyncio.wait does not cancel them when we're cancelled
+        await asyncio.wait(reader_tasks)
+        try:
+            return_code = await asyncio.wait_for(process.wait(), timeout=STOP_TIME_OUT_SECONDS)
+        except asyncio.TimeoutError:
+            logger.error(f"Model '{self.replica_name}' closed its output but did not exit, killing it")
+            process.kill()
+            return_code = await process.wait()
+
+        crashed_at = time.monotonic()
+        logger.error(f"Model '{self.replica_name}' exited unexpectedly with code {return_code}")
+        self.process = None
+        self.down_since = crashed_at
+        self.__change_status(LlmStatus.INIT_FAILED)
+        self.__fail_answer(HTTPException(status_code=503, detail=f"Model '{self.replica_name}' crashed"))
+        if self.up_since is not None and crashed_at - self.up_since > RESTART_RESET_SECONDS:
+            self.consecutive_restarts = 0
+        self.up_since = None
+
+        while self.consecutive_restarts < MAX_RESTARTS:
+            backoff = min(RESTART_BACKOFF_BASE_SECONDS * 2 ** self.consecutive_restarts, RESTART_BACKOFF_MAX_SECONDS)
+            self.consecutive_restarts += 1
+            logger.info(f"Restarting model '{self.replica_name}' in {backoff}s (attempt {self.consecutive_restarts})")
+            await asyncio.sleep(backoff)
+            self.restart_count += 1
+            self.metrics.record_restart()
+            try:
+                # Hands the supervision over to the restarted process. Started like on demand, so the npu memory
+                # budget is kept
+                self.__change_status(LlmStatus.IDLE)
+                if self.lifecycle_manager is not None:
+                    await self.lifecycle_manager.ensure_model_started(self)
+                else:
+                    await self.start_model()
+                return
+            except Exception as e:
+                logger.error(f"Error while restarting model '{self.replica_name}'! {repr(e)}")
+                self.__change_status(LlmStatus.INIT_FAILED)
+
+        logger.error(f"Model '{self.replica_name}' crashed {MAX_RESTARTS} times in a row, giving up")
+        self.unavailable_until = time.monotonic() + RESTART_BACKOFF_MAX_SECONDS
+        self.consecutive_restarts = 0
+        self.__change_status(LlmStatus.IDLE)
+        self.unavailable_event.set()
+
+    def __fail_answer(self, error: Exception):
+        sink = self.active_sink
+        self.active_sink = None
+        if sink is None:
+            return
+        self.__land(sink)
+        self.chat_sessions.lose_context()
+        sink.fail(error)
+        self.metrics.record_error("crash")
+        self.scheduler.release()
+
+    def __raise_if_unavailable(self):
+        retry_after = self.unavailable_until - time.monotonic()
+        if retry_after > 0:
+            raise HTTPException(status_code=503, detail=f"Model '{self.replica_name}' keeps crashing",
+                headers={"Retry-After": str(math.ceil(retry_after))})
+
+    def __record_uptime(self):
+        # The model is up (again), the time since the crash counts as downtime
+        self.up_since = time.monotonic()
+        if self.down_since is not None:
+            self.metrics.record_downtime(self.up_since - self.down_since)
+            self.down_since = None
+
+    # ---------------------------------------------
+    #               MODEL STOP
+    # ---------------------------------------------
+    async def stop_model(self):
+        """
+        Asks the model to quit (and kills it if it does not) in order to free the npu. The caller has to make sure
+        there is no prompt in flight, e.g. by holding the scheduler
+        """
+        # A stop is no crash, the model must not be restarted
+        if self.supervisor_task is not None:
+            self.supervisor_task.cancel()
+            self.supervisor_task = None
+        process = self.process
+        if process is None:
+            if self.get_status() == LlmStatus.INIT_FAILED:
+                # Stopped while waiting for its restart
+                self.__change_status(LlmStatus.IDLE)
+            return
+        logger.info(f"Stopping model '{self.replica_name}'")
+        try:
+            process.stdin.write(b"q\n")
+            await process.stdin.drain()
+            await asyncio.wait_for(process.wait(), timeout=STOP_TIME_OUT_SECONDS)
+        except (asyncio.TimeoutError, ConnectionError) as e:
+            logger.warning(f"Model '{self.replica_name}' did not quit, killing it. {repr(e)}")
+            process.kill()
+            await process.wait()
+        await asyncio.gather(*self.reader_tasks, return_exceptions=True)
+        self.process = None
+        self.reader_tasks = []
+        self.__change_status(LlmStatus.IDLE)
+        logger.info(f"Model '{self.replica_name}' stopped")
 
     # ---------------------------------------------
     #               READINESS WAIT
     # ---------------------------------------------
-    def await_readiness(self, timeout=120):
-        logger.debug(f"Wait for {timeout}s for model {self.model_name} to become ready. Current status: {self.get_status()}, ready_event: {self.ready_event}")
-        if not self.ready_event.wait(timeout=timeout):
-            raise TimeoutError(f"{self.model_name} did not become ready in time")
-        logger.debug(f"'{self.model_name}' became ready, done await_readiness!")
+    async def await_readiness(self, timeout=120):
+        logger.debug(f"Wait for {timeout}s for model {self.replica_name} to become ready. Current status: {self.get_status()}, ready_event: {self.ready_event}")
+        ready = asyncio.create_task(self.ready_event.wait())
+        given_up = asyncio.create_task(self.unavailable_event.wait())
+        try:
+            await asyncio.wait((ready, given_up), timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            ready.cancel()
+            given_up.cancel()
+        if not self.ready_event.is_set():
+            if self.unavailable_event.is_set():
+                self.__raise_if_unavailable()
+            raise TimeoutError(f"{self.replica_name} did not become ready in time")
+        logger.debug(f"'{self.replica_name}' became ready, done await_readiness!")
+
+    async def await_startup(self, timeout: float = READINESS_TIME_OUT_SECONDS) -> bool:
+        """
+        Waits until the model process started by start_model_process is ready or has exited (e.g. after its
+        initialization failed), i.e. until it no longer initializes on the npu. Returns whether it's ready
+        """
+        process = self.process
+        if process is None:
+            return self.ready_event.is_set()
+        ready = asyncio.create_task(self.ready_event.wait())
+        exited = asyncio.create_task(process.wait())
+        try:
+            await asyncio.wait((ready, exited), timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            ready.cancel()
+            exited.cancel()
+        return self.ready_event.is_set()
 
     # ---------------------------------------------
     #               GETTERS
@@ -149,86 +697,172 @@ class LlmService:
         with self.status_lock:
             return self.status
 
-    def get_status_history(self):
+    def get_status_history(self, since: float | None = None, limit: int | None = None) -> list[dict]:
+        """
+        Returns the status transitions (oldest first) after the given unix timestamp, at most 'limit' of them.
+        The timestamp of the last one returned is the 'since' of the next page
+        """
         with self.status_lock:
-            return self.status_history
+            entries = [dict(entry) for entry in self.status_history if since is None or entry["timestamp"] > since]
+        return entries[:limit] if limit is not None else entries
+
+    def get_startup_timeline(self):
+        return dict(self.startup_timeline)
+
+    def get_idle_seconds(self) -> float:
+        return time.monotonic() - self.last_used_at
+
+    def get_restart_count(self) -> int:
+        return self.restart_count
+
+    def is_unavailable(self) -> bool:
+        # Given up after too many crashes
+        return time.monotonic() < self.unavailable_until
+
+    def get_status_durations(self) -> dict:
+        """
+        Returns the total seconds spent in each status, including the time in the current one
+        """
+        with self.status_lock:
+            status_durations = dict(self.status_durations)
+            status_durations[self.status.name] = status_durations.get(self.status.name, 0) + time.monotonic() - self.status_since
+        return status_durations
+
+    def get_utilisation(self) -> float:
+        """
+        Returns the share of the time the model was up (ready or answering) which it spent answering prompts
+        """
+        status_durations = self.get_status_durations()
+        busy_seconds = sum(status_durations.get(status.name, 0) for status in BUSY_STATUSES)
+        up_seconds = busy_seconds + status_durations.get(LlmStatus.READY.name, 0)
+        return round(busy_seconds / up_seconds, 4) if up_seconds > 0 else 0
 
     # ---------------------------------------------
     #               LLM OUTPUT HANDLER
     # ---------------------------------------------
-    def __read_from_llm_stdout(self, pipe, tag):
-        for line in pipe:
-            line = line.rstrip("\n").strip()
-            logger.debug(f"LlmService: read msg from llm: {line}, tag: {tag}, status: {self.get_status()}")
-
-            # Push to queue and notify listeners
-            self.output_queue.put(line)
+    async def __read_from_llm_stdout(self, pipe: asyncio.StreamReader, tag):
+        while line := await pipe.readline():
+            # Only the line break is dropped, tokens keep their whitespace (like the leading space of a word)
+            line = line.decode(errors="replace").rstrip("\n")
+            if not line:
+                continue
+            logger.debug("LlmService: read msg from llm: %s, tag: %s", line, tag)
+
+            # Classify the line once and notify listeners
+            output = classify(line)
             for listener in self.output_listeners:
                 try:
-                    listener(line)
+                    listener(output)
                 except Exception as e:
-                    logger.error("Error during processing message from llm. line: {line}, listener: {listener}!", repr(e))
-
-    def __process_llm_output(self, line):
-        if line == None or line == '':
-            return
-        logger.debug(f"LlmService: process msg from llm: {line}")
+                    logger.error("Error during processing message from llm. line: %s, listener: %s! %s", line, listener, repr(e))
+
+    def __process_llm_output(self, output: LlmOutput):
+        # ANSWERING state, this is the hot path: in live_print mode the model prints one line per token
+        if output.type == LlmOutputType.TEXT:
+            sink = self.active_sink
+            if sink is not None and self.status == LlmStatus.ANSWERING:
+                sink.write(output.line)
+            elif self.status == LlmStatus.RESETTING and self.chat_sessions.reset_ack and self.chat_sessions.reset_ack in output.line:
+                logger.debug("Context reset acknowledged: %s", output.line)
+                self.reset_done.set()
+            else:
+                logger.debug("Message %s from llm is ignored!", output.line)
         # ERROR states
-        if SET_AXCL_DEVICE_FAILED_PATTERN.match(line) != None 
-            or INIT_FAILED_PATTERN.match(line) != None or SEG_FAULT_PATTERN.match(line) != None:
+        elif output.type == LlmOutputType.INIT_FAILED:
             self.__change_status(LlmStatus.INIT_FAILED)
-            logger.error(f"Model initialization failed, reason={line}")
+            logger.error(f"Model initialization failed, reason={output.line}")
         # INIT state
-        elif INIT_START_PATTERN.match(line) != None:
+        elif output.type == LlmOutputType.INIT_START:
             self.__change_status(LlmStatus.INIT)
             logger.info("Start initializing model..")
         # READY state
-        elif INIT_OK_PATTERN.match(line) != None:
+        elif output.type == LlmOutputType.INIT_OK:
             self.__change_status(LlmStatus.READY)
             logger.info("Model is ready!")
-        # ANSWERING state, first check if llm is done. If not, collect answer if still answering
-        elif HIT_EOS_PATTERN.match(line) != None:
+        # Log lines of the runtime (e.g. the ttft) are no part of the answer
+        elif output.type == LlmOutputType.LOG:
+            logger.debug("Log line %s from llm is ignored", output.line)
+        # ANSWERING state, llm is done
+        elif output.type == LlmOutputType.EOS:
+            if self.status == LlmStatus.RESETTING:
+                logger.debug("Context reset acknowledged")
+                self.reset_done.set()
+                return
             self.__change_status(LlmStatus.ANSWERING_DONE)
+            self.__complete_answer()
             logger.info("Model has answered!")
-        elif self.get_status() == LlmStatus.ANSWERING:
-            self.llm_response_buffer.write(line)
-        else:
-            logger.debug(f"Message {line} from llm is ignored!")
 
-    def __start_tokenizer_and_await_readiness(self):
+    async def __start_tokenizer_and_await_readiness(self):
         logger.debug(f"Start tokenizer if necessary")
-        response = requests.get(f"{TOKENIZER_STATUS_API.format(self.tokenizer_ip)}/{self.model_name}")
-        tokenizer_status = response.json()["status"]
+        tokenizer_status = await asyncio.to_thread(self.__get_tokenizer_status)
 
         # Start tokenizer only if idle (=not yet started)
         if tokenizer_status == TokenizerStatus.IDLE.value:
-            self.__start_tokenizer()
+            await asyncio.to_thread(self.__start_tokenizer)
 
-        # Now wait for tokenizer readiness. 1s steps in order to avoid segmentation fault
+        # Now wait for tokenizer readiness (the model would crash if the tokenizer is not ready yet)
+        deadline = time.monotonic() + TOKENIZER_TIME_OUT_SECONDS
         while tokenizer_status != TokenizerStatus.READY.value:
-            response = requests.get(f"{TOKENIZER_STATUS_API.format(self.tokenizer_ip)}/{self.model_name}")
-            tokenizer_status = response.json()["status"]
+            if time.monotonic() > deadline:
+                raise TimeoutError(f"Tokenizer of {self.replica_name} did not become ready in time")
             logger.debug(f"Waiting for tokenizer... Current status={tokenizer_status}")
-            sleep(0.1)
+            tokenizer_status = await asyncio.to_thread(self.__await_tokenizer_ready)
         logger.debug("Tokenizer ready!")
 
+    def __get_tokenizer_status(self):
+        response = tokenizer_session.get(f"{TOKENIZER_STATUS_API.format(self.tokenizer_ip)}/{self.replica_name}",
+            timeout=TOKENIZER_REQUEST_TIME_OUT_SECONDS)
+        tokenizer_status = response.json()
+        # If the tokenizer is shared with another model, it listens at the port of that model
+        tokenizer_port = int(tokenizer_status.get("port", self.tokenizer_port))
+        if tokenizer_port != self.tokenizer_port:
+            logger.info(f"Model '{self.replica_name}' uses the shared tokenizer at port {tokenizer_port}")
+            self.tokenizer_port = tokenizer_port
+            self.token_counter = TokenCounter(self.tokenizer_ip, tokenizer_port)
+        return tokenizer_status["status"]
+
+    def __await_tokenizer_ready(self):
+        # Returns as soon as the tokenizer is ready, or with the current status after the long-poll timeout
+        response = tokenizer_session.get(f"{TOKENIZER_STATUS_API.format(self.tokenizer_ip)}/{self.replica_name}/wait",
+            params={"status": TokenizerStatus.READY.value, "timeout": TOKENIZER_LONG_POLL_SECONDS},
+            timeout=TOKENIZER_LONG_POLL_SECONDS + TOKENIZER_REQUEST_TIME_OUT_SECONDS)
+        return response.json()["status"]
+
     def __start_tokenizer(self):
         data = {
-            "name": self.model_name,
+            "name": self.replica_name,
             "port": self.tokenizer_port,
             "tokenizer_py": self.tokenizer_py,
             "tokenizer_path": self.tokenizer_path
         }
         logger.info("Request starting tokenizer")
-        requests.post(TOKENIZER_START_API.format(self.tokenizer_ip), json=data)
+        tokenizer_session.post(TOKENIZER_START_API.format(self.tokenizer_ip), json=data, timeout=TOKENIZER_REQUEST_TIME_OUT_SECONDS)
 
     def __change_status(self, new_status: LlmStatus):
+        now = time.monotonic()
         with self.status_lock:
+            if self.status is not None:
+                duration = now - self.status_since
+                self.status_durations[self.status.name] = self.status_durations.get(self.status.name, 0) + duration
+                self.status_history[-1]["duration"] = round(duration, 3)
             self.status = new_status
-        self.status_history.append(new_status)
+            self.status_since = now
+            self.status_history.append({"status": new_status.name, "timestamp": time.time(), "duration": None})
+        if self.startup_started_at is not None and new_status in STARTUP_PHASES:
+            self.__record_startup_phase(new_status)
         if new_status == LlmStatus.READY:
             self.ready_event.set()
         else:
             self.ready_event.clear()
-        if new_status == LlmStatus.ANSWERING_DONE:
-            self.prompt_answered_event.set()
+
+    def __collect_metrics(self):
+        self.metrics.record_status(self.get_status().value, self.get_status_durations(), self.scheduler.get_queue_depth())
+
+    def __record_startup_phase(self, phase: LlmStatus):
+        self.startup_timeline[phase.name] = round(time.monotonic() - self.startup_started_at, 3)
+        # The startup is over, further transitions are about prompts
+        if phase in (LlmStatus.READY, LlmStatus.INIT_FAILED):
+            self.startup_started_at = None
+            if phase == LlmStatus.READY:
+                self.__record_uptime()
+            self.metrics.record_startup_timeline(self.startup_timeline)
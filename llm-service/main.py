@@ -1,19 +1,38 @@
+import asyncio
 import json
 import logging
-import threading
-from fastapi import FastAPI, HTTPException
+from contextlib import asynccontextmanager
+from datetime import datetime, timezone
+from fastapi import FastAPI, Header, HTTPException, Request, Response
+from fastapi.responses import PlainTextResponse, StreamingResponse
 from pydantic import BaseModel
 from time import sleep
 from modelhelper import ModelHelper
 from llmservice import LlmService
 from llmservice import LlmStatus
-
-app = FastAPI(title="AX-M1 LLM API")
+from metrics import METRICS_TEXTFILE, REGISTRY, write_textfile_periodically
+from requesttracing import RequestTrace, SlowRequests
 
 model_helper = ModelHelper()
 model_helper.create_llm_services()
-# Start the models async
-threading.Thread(target=model_helper.start_default_llm_services, daemon=True).start()
+slow_requests = SlowRequests()
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Start the models async, the api is available in the meantime
+    startup_task = asyncio.create_task(model_helper.start_default_llm_services())
+    idle_task = asyncio.create_task(model_helper.stop_idle_models())
+    textfile_task = asyncio.create_task(write_textfile_periodically()) if METRICS_TEXTFILE else None
+    reload_task = asyncio.create_task(model_helper.watch_model_descriptors())
+    yield
+    startup_task.cancel()
+    idle_task.cancel()
+    reload_task.cancel()
+    if textfile_task is not None:
+        textfile_task.cancel()
+
+app = FastAPI(title="AX-M1 LLM API", lifespan=lifespan)
 
 logger = logging.getLogger("uvicorn.error")
 logger.setLevel(logging.DEBUG)
@@ -24,51 +43,206 @@ class LlmGenerateRequest(BaseModel):
     prompt: str
     images: list[str] | None = None
     options: dict | None = None
+    stream: bool = False
+    # Max. seconds the prompt may wait until the model is free
+    deadline_seconds: float | None = None
+    # Adds the seconds spent in each stage of the prompt (queue, readiness, prefill, decode..) to the answer
+    timings: bool = False
+
+class LlmChatRequest(BaseModel):
+    model: str
+    # Ollama-like messages with 'role' (system, user or assistant) and 'content'. The last one has to be the user's
+    messages: list[dict]
+    options: dict | None = None
+    stream: bool = False
+    # Max. seconds the prompt may wait until the model is free
+    deadline_seconds: float | None = None
+    # Adds the seconds spent in each stage of the prompt (queue, readiness, prefill, decode..) to the answer
+    timings: bool = False
 
 class ShowRequest(BaseModel):
     name: str
 
 
 @app.post("/api/generate")
-def generate(req: LlmGenerateRequest):
+async def generate(req: LlmGenerateRequest, response: Response, x_request_id: str | None = Header(None)):
     """
     Forwards a prompt to the persistent model process.
-    If there the model is not yet ready, wait until it is
+    If there the model is not yet ready or busy, wait until it is (or reject the prompt if too many are waiting).
+    With 'stream' set, the answer is returned as newline-delimited json chunks (like ollama does).
+    The (last chunk of the) answer contains the token counts and durations of the prompt.
+    The time spent in each stage of the prompt is reported in the 'Server-Timing' header (and in the answer if
+    'timings' is set), the request id in the 'X-Request-ID' header
+    """
+    trace = RequestTrace(req.model, "generate", x_request_id)
+    try:
+        logger.info(f"Received generate request {trace.request_id} for model '{req.model}' with prompt: {req.prompt}")
+        llm_router = model_helper.get_llmrouter(req.model)
+        if req.stream:
+            chunks = await llm_router.prompt_llm_stream(req.prompt, req.deadline_seconds, req.options, trace=trace)
+            return StreamingResponse(to_ndjson(req.model, chunks, trace, req.timings), media_type="application/x-ndjson",
+                headers=get_trace_headers(trace, include_total=False))
+        answer = await llm_router.prompt_llm_with_stats(req.prompt, req.deadline_seconds, req.options, trace=trace)
+        finish_trace(trace, response)
+        return {"model": req.model, "created_at": datetime.now(timezone.utc).isoformat(), **answer,
+            **get_timings(trace, req.timings)}
+    except Exception as e:
+        raise to_http_exception(trace, e)
+
+@app.post("/api/chat")
+async def chat(req: LlmChatRequest, response: Response, x_request_id: str | None = Header(None)):
+    """
+    Answers the last message of a conversation, like ollama does. If the model keeps the context of the conversation,
+    only the new message is sent to it (see ChatSessions). The timings are reported like for /api/generate
+    """
+    trace = RequestTrace(req.model, "chat", x_request_id)
+    try:
+        logger.info(f"Received chat request {trace.request_id} for model '{req.model}' with {len(req.messages)} messages")
+        llm_router = model_helper.get_llmrouter(req.model)
+        if req.stream:
+            chunks = await llm_router.chat_llm_stream(req.messages, req.deadline_seconds, req.options, trace=trace)
+            return StreamingResponse(to_ndjson(req.model, to_chat_chunks(chunks), trace, req.timings),
+                media_type="application/x-ndjson", headers=get_trace_headers(trace, include_total=False))
+        answer = await llm_router.chat_llm_with_stats(req.messages, req.deadline_seconds, req.options, trace=trace)
+        finish_trace(trace, response)
+        return {"model": req.model, "created_at": datetime.now(timezone.utc).isoformat(), **to_chat_chunk(answer),
+            **get_timings(trace, req.timings)}
+    except Exception as e:
+        raise to_http_exception(trace, e)
+
+def finish_trace(trace: RequestTrace, response: Response | None = None, error: Exception | None = None):
+    trace.finish(error)
+    slow_requests.record(trace)
+    if response is not None:
+        response.headers.update(get_trace_headers(trace))
+
+def get_trace_headers(trace: RequestTrace, include_total: bool = True) -> dict:
+    return {"X-Request-ID": trace.request_id, "Server-Timing": trace.to_server_timing(include_total)}
+
+def get_timings(trace: RequestTrace, requested: bool) -> dict:
+    return {"timings": trace.get_timings()} if requested else {}
+
+def to_http_exception(trace: RequestTrace, error: Exception) -> HTTPException:
+    finish_trace(trace, error=error)
+    if not isinstance(error, HTTPException):
+        error = HTTPException(500, str(error))
+    error.headers = {**(error.headers or {}), "X-Request-ID": trace.request_id}
+    return error
+
+@app.post("/api/batch")
+async def batch(request: Request, model: str, offset: int = 0):
+    """
+    Answers a batch of prompts for one model, e.g. for bulk jobs. The body is JSONL with one {"prompt": .., "options": ..}
+    per line. The results are returned as newline-delimited json, one per prompt (with its index) in the order of the
+    prompts as soon as they're answered, and a last one with the aggregate throughput and the failed prompts.
+    An interrupted batch can be resumed by sending it again with the index after the last result as 'offset'
     """
     try:
-        logger.info(f"Received generate request for model '{req.model}' with prompt: {req.prompt}")
-        llm_service = model_helper.get_llmservice(req.model)
-        if llm_service.get_status() == LlmStatus.IDLE:
-            logger.info(f"Prompt requested, but model '{req.model}' is not started yet -> starting model")
-            llm_service.start_model()
-        llm_service.await_readiness(timeout=300)
-        response = llm_service.prompt_llm(req.prompt)
-        return {"response": response}
+        if offset < 0:
+            raise HTTPException(400, "The offset must not be negative")
+        items = to_batch_items(await request.body())
+        logger.info(f"Received batch of {len(items)} prompts for model '{model}', starting at {offset}")
+        llm_router = model_helper.get_llmrouter(model)
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(500, str(e))
+    return StreamingResponse(to_ndjson(model, llm_router.prompt_llm_batch(items, offset)), media_type="application/x-ndjson")
+
+def to_batch_items(body: bytes) -> list[dict]:
+    items = []
+    for line_number, line in enumerate(body.decode().splitlines(), start=1):
+        if not line.strip():
+            continue
+        try:
+            item = json.loads(line)
+        except json.JSONDecodeError as e:
+            raise HTTPException(400, f"Line {line_number} of the batch is no valid json: {e}")
+        if not isinstance(item, dict) or not isinstance(item.get("prompt"), str):
+            raise HTTPException(400, f"Line {line_number} of the batch has no 'prompt'")
+        items.append(item)
+    return items
+
+async def to_chat_chunks(chunks):
+    async for chunk in chunks:
+        yield to_chat_chunk(chunk)
+
+def to_chat_chunk(chunk: dict) -> dict:
+    # The answer of a chat is a message instead of a response
+    chunk = dict(chunk)
+    return {"message": {"role": "assistant", "content": chunk.pop("response")}, **chunk}
+
+async def to_ndjson(model_name: str, chunks, trace: RequestTrace | None = None, timings: bool = False):
+    """
+    Turns the chunks of a streamed answer into newline-delimited json. Since the http status is already sent
+    at this point, errors are reported as a last chunk (again like ollama does). The timings of the prompt
+    (if requested) are added to the last chunk
+    """
+    error = None
+    try:
+        async for chunk in chunks:
+            created_at = datetime.now(timezone.utc).isoformat()
+            if chunk.get("done") and trace is not None:
+                trace.finish()
+                chunk = {**chunk, **get_timings(trace, timings)}
+            yield json.dumps({"model": model_name, "created_at": created_at, **chunk}) + "\n"
+    except Exception as e:
+        error = e
+        logger.error(f"Error while streaming answer of model '{model_name}': {repr(e)}")
+        yield json.dumps({"error": str(e)}) + "\n"
+    finally:
+        if trace is not None:
+            finish_trace(trace, error=error)
+
+@app.get("/metrics")
+async def metrics():
+    """
+    Reports the metrics of all models in the Prometheus text format
+    """
+    return PlainTextResponse(REGISTRY.render(), media_type="text/plain; version=0.0.4")
+
+@app.get("/api/debug/slow_requests")
+async def debug_slow_requests():
+    """
+    Reports the most recent requests which took longer than SLOW_REQUEST_SECONDS, with the time spent in each stage
+    """
+    return {"threshold_seconds": slow_requests.threshold_seconds, "slow_requests": slow_requests.get_requests()}
 
 @app.get("/api/status/{model_name}")
-def status(model_name):
+async def status(model_name):
     """
-    Reports the current status of the given model
+    Reports the current status of the given model (resp. its first replica) or replica (like 'model@1').
+    If the model has several replicas, their names are listed
     """
     try:
         llm_service = model_helper.get_llmservice(model_name)
-        return {
-            "status": llm_service.get_status()
+        status = {
+            "status": llm_service.get_status(),
+            "queue_depth": llm_service.scheduler.get_queue_depth(),
+            "restarts": llm_service.get_restart_count(),
+            "chat_sessions": llm_service.chat_sessions.get_session_count(),
+            "startup_timeline": llm_service.get_startup_timeline()
         }
+        if model_name in model_helper.name_to_llm_routers:
+            replicas = model_helper.get_llmrouter(model_name).replicas
+            if len(replicas) > 1:
+                status["replicas"] = [replica.replica_name for replica in replicas]
+        return status
     except Exception as e:
         raise HTTPException(500, str(e))
 
 @app.get("/api/status_history/{model_name}")
-def status(model_name):
+async def status_history(model_name, since: float | None = None, limit: int = 100):
     """
-    Reports all status transition of the given model.
+    Reports the recent status transitions of the given model (oldest first, after the unix timestamp 'since'),
+    along with the total seconds it spent in each status and its utilisation (answering vs. ready)
     """
     try:
         llm_service = model_helper.get_llmservice(model_name)
         return {
-            "status_history": llm_service.get_status_history()
+            "status_history": llm_service.get_status_history(since, limit),
+            "status_durations": {status: round(seconds, 3) for status, seconds in llm_service.get_status_durations().items()},
+            "utilisation": llm_service.get_utilisation()
         }
     except Exception as e:
         raise HTTPException(500, str(e))
@@ -79,7 +253,18 @@ async def list_models():
     """
     Mimics: GET /api/tags
     """
-    return {"models": model_helper.get_model_descriptors()}
+    return model_helper.get_tags()
+
+@app.post("/api/admin/reload_models")
+async def reload_models():
+    """
+    Reloads the model-descriptors right away (instead of waiting until the change is noticed). Only the models which
+    were added, changed or removed are (re)created resp. stopped
+    """
+    try:
+        return await model_helper.reload_llm_services()
+    except Exception as e:
+        raise HTTPException(500, str(e))
 
 
 @app.post("/api/show")
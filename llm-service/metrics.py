@@ -1,49 +1,254 @@
+import asyncio
 import logging
-import re
-import threading
-from pathlib import Path
+import os
+from outputclassifier import LlmOutput
 
-METRICS_FILE = "/app/metrics/axm1-llm-{0}-metrics.prom"
-AVG_TOKEN_PATTERN = re.compile("(avg)(.*)(token\/s$)")
+# If set, all metrics are written to this file periodically (e.g. for the textfile collector of the node exporter)
+METRICS_TEXTFILE = os.environ.get("METRICS_TEXTFILE")
+METRICS_TEXTFILE_INTERVAL_SECONDS = float(os.environ.get("METRICS_TEXTFILE_INTERVAL_SECONDS", "15"))
+# Prompts take from milliseconds (cached) up to minutes (long answers of large models)
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120, 300, 600)
 
 logger = logging.getLogger("uvicorn.error")
 logger.setLevel(logging.DEBUG)
 
 
-class Metrics:
+# One metric with all its label combinations, rendered in the Prometheus text format
+class Metric:
+
+    def __init__(self, name: str, help_text: str, metric_type: str, label_names: tuple):
+        self.name = name
+        self.help_text = help_text
+        self.metric_type = metric_type
+        self.label_names = label_names
+        # label values -> value
+        self.values = {}
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} {self.metric_type}"]
+        for label_values, value in self.values.items():
+            lines += self.render_value(label_values, value)
+        return lines
+
+    def render_value(self, label_values: tuple, value) -> list[str]:
+        return [f"{self.name}{format_labels(self.label_names, label_values)} {format_value(value)}"]
+
+    def remove(self, *label_prefix):
+        # Removes all values whose labels start with the given ones
+        for label_values in [label_values for label_values in self.values if label_values[:len(label_prefix)] == label_prefix]:
+            del self.values[label_values]
+
+
+class Counter(Metric):
+
+    def __init__(self, name: str, help_text: str, label_names: tuple):
+        super().__init__(name, help_text, "counter", label_names)
+
+    def inc(self, *label_values, amount: float = 1):
+        self.values[label_values] = self.values.get(label_values, 0) + amount
+
+
+class Gauge(Metric):
+
+    def __init__(self, name: str, help_text: str, label_names: tuple):
+        super().__init__(name, help_text, "gauge", label_names)
+
+    def set(self, *label_values, value: float):
+        self.values[label_values] = value
+
+
+class Histogram(Metric):
+
+    def __init__(self, name: str, help_text: str, label_names: tuple, buckets: tuple = LATENCY_BUCKETS):
+        super().__init__(name, help_text, "histogram", label_names)
+        self.buckets = buckets
+
+    def observe(self, *label_values, value: float):
+        # [count per bucket.., sum, count]. The buckets are made cumulative when rendered
+        observations = self.values.get(label_values)
+        if observations is None:
+            observations = self.values[label_values] = [0] * (len(self.buckets) + 2)
+        for index, bucket in enumerate(self.buckets):
+            if value <= bucket:
+                observations[index] += 1
+                break
+        observations[-2] += value
+        observations[-1] += 1
+
+    def render_value(self, label_values: tuple, observations: list) -> list[str]:
+        lines = []
+        cumulative = 0
+        for bucket, count in zip(self.buckets + ("+Inf",), observations[:-2] + [observations[-1]]):
+            cumulative = count if bucket == "+Inf" else cumulative + count
+            labels = format_labels(self.label_names + ("le",), label_values + (str(bucket),))
+            lines.append(f"{self.name}_bucket{labels} {cumulative}")
+        labels = format_labels(self.label_names, label_values)
+        lines.append(f"{self.name}_sum{labels} {format_value(observations[-2])}")
+        lines.append(f"{self.name}_count{labels} {observations[-1]}")
+        return lines
+
+
+# Holds all metrics of the llm-service. Collectors are called right before rendering, so values which are expensive
+# to track (or only interesting when scraped) are updated then
+class MetricsRegistry:
 
     def __init__(self):
+        self.metrics = []
+        self.collectors = []
+
+    def register(self, metric: Metric) -> Metric:
+        self.metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        for collector in list(self.collectors):
+            try:
+                collector()
+            except Exception as e:
+                logger.error(f"Error while collecting metrics from {collector}! {repr(e)}")
+        lines = []
+        for metric in self.metrics:
+            lines += metric.render()
+        return "\n".join(lines) + "\n"
+
+
+def format_labels(label_names: tuple, label_values: tuple) -> str:
+    if not label_names:
+        return ""
+    labels = ",".join(f'{name}="{escape_label_value(value)}"' for name, value in zip(label_names, label_values))
+    return "{" + labels + "}"
+
+
+def escape_label_value(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def format_value(value: float) -> str:
+    return str(round(value, 6)) if isinstance(value, float) else str(value)
+
+
+REGISTRY = MetricsRegistry()
+REQUESTS = REGISTRY.register(Counter("axm1_llm_requests_total", "Prompts received", ("model", "replica")))
+ERRORS = REGISTRY.register(Counter("axm1_llm_errors_total", "Prompts which failed, by cause", ("model", "replica", "cause")))
+QUEUE_WAIT = REGISTRY.register(Histogram("axm1_llm_queue_wait_seconds", "Time the prompt waited for the model", ("model", "replica")))
+TIME_TO_FIRST_TOKEN = REGISTRY.register(Histogram("axm1_llm_time_to_first_token_seconds",
+    "Time from sending the prompt to the model until its first output", ("model", "replica")))
+REQUEST_DURATION = REGISTRY.register(Histogram("axm1_llm_request_duration_seconds",
+    "Time from receiving the prompt until the model has answered", ("model", "replica")))
+PROMPT_TOKENS = REGISTRY.register(Counter("axm1_llm_prompt_tokens_total", "Prompt tokens", ("model", "replica")))
+TOKENS_GENERATED = REGISTRY.register(Counter("axm1_llm_tokens_generated_total", "Output tokens", ("model", "replica")))
+TOKENS_PER_SECOND = REGISTRY.register(Gauge("axm1_llm_tokens_per_second", "Token throughput of the last answer", ("model", "replica")))
+COALESCED_PROMPTS = REGISTRY.register(Counter("axm1_llm_coalesced_prompts_total",
+    "Prompts which joined an identical prompt in flight", ("model", "replica")))
+PROMPTS_TRUNCATED = REGISTRY.register(Counter("axm1_llm_prompts_truncated_total",
+    "Prompts cut down to the token budget of the model", ("model", "replica")))
+CACHE_HITS = REGISTRY.register(Counter("axm1_llm_cache_hits_total", "Prompts answered from the response cache", ("model", "replica")))
+CACHE_MISSES = REGISTRY.register(Counter("axm1_llm_cache_misses_total", "Prompts not found in the response cache", ("model", "replica")))
+QUEUE_DEPTH = REGISTRY.register(Gauge("axm1_llm_queue_depth", "Prompts waiting for the model", ("model", "replica")))
+STATUS = REGISTRY.register(Gauge("axm1_llm_status", "Current status of the model (see LlmStatus)", ("model", "replica")))
+STATUS_DURATION = REGISTRY.register(Gauge("axm1_llm_status_duration_seconds", "Total seconds the model spent in each status",
+    ("model", "replica", "status")))
+STARTUP_PHASE = REGISTRY.register(Gauge("axm1_llm_startup_phase_seconds",
+    "Seconds since the model start until the phase was reached", ("model", "replica", "phase")))
+RESTARTS = REGISTRY.register(Counter("axm1_llm_restarts_total", "Restarts of the model after a crash", ("model", "replica")))
+DOWNTIME = REGISTRY.register(Counter("axm1_llm_downtime_seconds_total", "Seconds the model was down after crashes", ("model", "replica")))
+
+
+# Records the metrics of one model (replica) into the registry
+class Metrics:
+
+    def __init__(self, model_name: str, replica_name: str | None = None):
+        self.labels = (model_name, replica_name or model_name)
         self.avg_token_per_second = None
+        self.collectors = []
+
+    def record_request(self):
+        REQUESTS.inc(*self.labels)
+
+    def record_error(self, cause: str):
+        ERRORS.inc(*self.labels, cause)
+
+    def record_cache_lookup(self, hit: bool):
+        (CACHE_HITS if hit else CACHE_MISSES).inc(*self.labels)
+
+    def record_coalesced_prompt(self):
+        COALESCED_PROMPTS.inc(*self.labels)
+
+    def record_prompt_truncated(self):
+        PROMPTS_TRUNCATED.inc(*self.labels)
 
-    def write(self, model_name: str, duration: float, response: str):
-        """Writes Prometheus-compatible metrics for Node Exporter."""
-        try:
-            # Extract the avg token/s from the llm (if present). And if not, calculate
-            token_count = len(response.split())
-            if self.avg_token_per_second:
-                tps = self.avg_token_per_second
-            else:
-                tps = token_count / duration if duration > 0 else 0
-
-            metrics = [
-                f"# HELP axm1_llm_inference_{model_name}_duration_seconds LLM inference duration",
-                f"# TYPE axm1_llm_inference_{model_name}_duration_seconds gauge",
-                f"axm1_llm_inference_{model_name}_duration_seconds {duration:.2f}",
-                f"# HELP axm1_llm_inference_{model_name}_tokens_generated Output tokens",
-                f"# TYPE axm1_llm_inference_{model_name}_tokens_generated gauge",
-                f"axm1_llm_inference_{model_name}_tokens_generated {token_count}",
-                f"# HELP axm1_llm_inference_{model_name}_tokens_per_second Token throughput",
-                f"# TYPE axm1_llm_inference_{model_name}_tokens_per_second gauge",
-                f"axm1_llm_inference_{model_name}_tokens_per_second {tps:.2f}"
-            ]
-            Path(METRICS_FILE.format(model_name)).write_text("\n".join(metrics))
-        except Exception as e:
-            logger.error("Error while writing metrics!", repr(e))
-
-    def process_llm_output(self, line):
-        if line == None:
+    def record_queue_wait(self, queue_wait: float):
+        """Records the wait of a prompt which was rejected by the queue, answered prompts are recorded with their answer"""
+        QUEUE_WAIT.observe(*self.labels, value=queue_wait)
+
+    def record_answer(self, prompt_token_count: int, token_count: int, avg_token_per_second: float | None,
+        queue_wait: float, time_to_first_token: float, eval_duration: float, request_duration: float):
+        # Take the avg token/s the llm printed for this answer (if present). And if not, calculate
+        if avg_token_per_second:
+            tps = avg_token_per_second
+        else:
+            tps = token_count / eval_duration if eval_duration > 0 else 0
+        QUEUE_WAIT.observe(*self.labels, value=queue_wait)
+        TIME_TO_FIRST_TOKEN.observe(*self.labels, value=time_to_first_token)
+        REQUEST_DURATION.observe(*self.labels, value=request_duration)
+        PROMPT_TOKENS.inc(*self.labels, amount=prompt_token_count)
+        TOKENS_GENERATED.inc(*self.labels, amount=token_count)
+        TOKENS_PER_SECOND.set(*self.labels, value=tps)
+
+    def record_startup_timeline(self, startup_timeline: dict):
+        """Records the seconds from requesting the model start until each startup phase was reached"""
+        STARTUP_PHASE.remove(*self.labels)
+        for phase, seconds in startup_timeline.items():
+            STARTUP_PHASE.set(*self.labels, phase, value=seconds)
+
+    def record_restart(self):
+        RESTARTS.inc(*self.labels)
+
+    def record_downtime(self, seconds: float):
+        DOWNTIME.inc(*self.labels, amount=seconds)
+
+    def record_status(self, status_value: int, status_durations: dict, queue_depth: int):
+        STATUS.set(*self.labels, value=status_value)
+        for status_name, seconds in status_durations.items():
+            STATUS_DURATION.set(*self.labels, status_name, value=seconds)
+        QUEUE_DEPTH.set(*self.labels, value=queue_depth)
+
+    def add_collector(self, collector):
+        REGISTRY.collectors.append(collector)
+        self.collectors.append(collector)
+
+    def unregister(self, remove_values: bool = True):
+        """Removes the collectors and all values of the model (replica), e.g. because the model was removed.
+        The values are kept if a new replica with the same name records them from now on"""
+        for collector in self.collectors:
+            REGISTRY.collectors.remove(collector)
+        self.collectors = []
+        if not remove_values:
             return
-        match = AVG_TOKEN_PATTERN.search(line)
-        if match:
-            self.avg_token_per_second = float(match.group(2).strip())
-            logger.debug(f"Got avg-token line: {line}")
+        for metric in REGISTRY.metrics:
+            metric.remove(*self.labels)
+
+    def process_llm_output(self, output: LlmOutput):
+        if output.avg_token_per_second is not None:
+            self.avg_token_per_second = output.avg_token_per_second
+            logger.debug("Got avg-token line: %s", output.line)
+
+
+async def write_textfile_periodically():
+    """
+    Writes all metrics to METRICS_TEXTFILE every few seconds. The file is replaced at once, so the node exporter
+    never reads a half written file
+    """
+    while True:
+        await asyncio.sleep(METRICS_TEXTFILE_INTERVAL_SECONDS)
+        await asyncio.to_thread(write_textfile, REGISTRY.render())
+
+
+def write_textfile(content: str):
+    try:
+        tmp_path = f"{METRICS_TEXTFILE}.tmp"
+        with open(tmp_path, "w") as file:
+            file.write(content)
+        os.replace(tmp_path, METRICS_TEXTFILE)
+    except Exception as e:
+        logger.error(f"Error while writing metrics to '{METRICS_TEXTFILE}'! {repr(e)}")
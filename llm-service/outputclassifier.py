@@ -0,0 +1,63 @@
+import re
+from enum import Enum
+
+
+class LlmOutputType(Enum):
+    TEXT = 1
+    INIT_START = 2
+    INIT_OK = 3
+    INIT_FAILED = 4
+    # indicating that the model is done thinking and starts answering (answer may include thinking)
+    EOS = 5
+    # A log line of the runtime (like '[I][ Run][ 626]: ttft: 200.00 ms'), which is no part of the answer
+    LOG = 6
+
+
+# One classified line. A plain class with slots, since it's created for every token (a NamedTuple is way slower)
+class LlmOutput:
+    __slots__ = ("type", "line", "avg_token_per_second")
+
+    def __init__(self, output_type: LlmOutputType, line: str, avg_token_per_second: float | None = None):
+        self.type = output_type
+        self.line = line
+        # Only set for the line with the average token throughput of the last answer
+        self.avg_token_per_second = avg_token_per_second
+
+
+# All markers the model prints, in one pattern so each line is scanned only once. The group of a match tells the type
+MARKER_PATTERN = re.compile("(LLM init start)|(LLM init ok)|(Set AXCL device failed)|(lLaMa.Init failed)"
+    "|(Segmentation fault)|(hit eos)")
+MARKER_TYPES = (None, LlmOutputType.INIT_START, LlmOutputType.INIT_OK, LlmOutputType.INIT_FAILED,
+    LlmOutputType.INIT_FAILED, LlmOutputType.INIT_FAILED, LlmOutputType.EOS)
+# In live_print mode, most lines are single tokens which are shorter than any marker
+MIN_MARKER_LENGTH = len("hit eos")
+# A line contains a marker only if it contains one of these literals. Checking them is way cheaper than the pattern
+MARKER_LITERALS = ("LLM init", "AXCL device", "Init failed", "Segmentation", "hit eos")
+AVG_TOKEN_SUFFIX = "token/s"
+# Log lines of the runtime start with the level, the module and the line number
+LOG_PATTERN = re.compile(r"\[[A-Z]\]\[[^\]]*\]\[\s*\d+\]:")
+AVG_TOKEN_PATTERN = re.compile("(avg)(.*)(token\/s$)")
+
+
+def classify(line: str) -> LlmOutput:
+    """
+    Tells what the given line printed by the model is about
+    """
+    if len(line) < MIN_MARKER_LENGTH:
+        return LlmOutput(LlmOutputType.TEXT, line)
+    output_type = LlmOutputType.TEXT
+    for literal in MARKER_LITERALS:
+        if literal in line:
+            match = MARKER_PATTERN.search(line)
+            output_type = MARKER_TYPES[match.lastindex] if match else LlmOutputType.TEXT
+            break
+    if output_type == LlmOutputType.TEXT and line.startswith("[") and LOG_PATTERN.match(line):
+        output_type = LlmOutputType.LOG
+    avg_token_per_second = None
+    if line.endswith(AVG_TOKEN_SUFFIX):
+        avg_match = AVG_TOKEN_PATTERN.search(line)
+        try:
+            avg_token_per_second = float(avg_match.group(2).strip()) if avg_match else None
+        except ValueError:
+            pass
+    return LlmOutput(output_type, line, avg_token_per_second)
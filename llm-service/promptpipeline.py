@@ -0,0 +1,126 @@
+import logging
+import re
+from fastapi import HTTPException
+from tokencounter import TokenCounter
+
+logger = logging.getLogger("uvicorn.error")
+logger.setLevel(logging.DEBUG)
+
+# How the line breaks of a prompt are sent to the model, which reads one prompt per line: replaced by a space or
+# escaped as '\n' (for runtimes which unescape it)
+NEWLINE_MODES = ("space", "escape")
+DEFAULT_NEWLINE_MODE = "space"
+# Which part of a prompt exceeding the token budget is dropped. The question usually comes last, so the start
+TRUNCATE_SIDES = ("start", "end")
+DEFAULT_TRUNCATE_SIDE = "start"
+# Attempts to cut a prompt down to the token budget, each one asks the tokenizer
+MAX_TRUNCATE_ATTEMPTS = 5
+# Weight of the latest prefill in the learned prefill rate
+PREFILL_RATE_SMOOTHING = 0.2
+# The prefill of short prompts is mostly fixed overhead, the rate is only learned from longer ones
+MIN_PREFILL_TOKENS_TO_LEARN = 64
+LINE_BREAK_PATTERN = re.compile("\r\n|\r|\n")
+# Placeholders of the template. Prompts are full of braces, so they're substituted instead of formatted
+PLACEHOLDER_PATTERN = re.compile(r"\{(system_prompt|prompt)\}")
+
+
+# Turns a prompt into what is written to the stdin of the model: one line, rendered with the template (and system
+# prompt) of the model and cut down to its token budget. Prefill grows with the prompt tokens, so a prompt whose
+# estimated prefill takes longer than the deadline of its client is rejected instead of blocking the model. The
+# prefill rate (prompt tokens per second) is taken from the descriptor or, if enabled, learned from the answered prompts
+class PromptPipeline:
+
+    def __init__(self, template: str | None = None, system_prompt: str = "", newline_mode: str = DEFAULT_NEWLINE_MODE,
+        max_prompt_tokens: int | None = None, truncate_side: str = DEFAULT_TRUNCATE_SIDE,
+        prefill_tokens_per_second: float | None = None, learn_prefill_rate: bool = False):
+        if newline_mode not in NEWLINE_MODES:
+            raise ValueError(f"Unknown newline mode '{newline_mode}', expected one of {NEWLINE_MODES}")
+        if truncate_side not in TRUNCATE_SIDES:
+            raise ValueError(f"Unknown truncate side '{truncate_side}', expected one of {TRUNCATE_SIDES}")
+        if template is not None and "{prompt}" not in template:
+            raise ValueError("The prompt template has no '{prompt}'")
+        self.newline_mode = newline_mode
+        self.template = self.to_line(template) if template is not None else None
+        self.system_prompt = self.to_line(system_prompt)
+        self.max_prompt_tokens = max_prompt_tokens
+        self.truncate_side = truncate_side
+        self.prefill_tokens_per_second = prefill_tokens_per_second
+        self.learn_prefill_rate = learn_prefill_rate
+
+    def to_line(self, text: str) -> str:
+        """
+        Encodes the text as one line, so the model doesn't take its lines for several prompts
+        """
+        return LINE_BREAK_PATTERN.sub(" " if self.newline_mode == "space" else "\\\\n", text)
+
+    def render(self, prompt: str) -> str:
+        # In one pass, so a placeholder within the system prompt or the prompt is left alone
+        if self.template is None:
+            return prompt
+        values = {"system_prompt": self.system_prompt, "prompt": prompt}
+        return PLACEHOLDER_PATTERN.sub(lambda match: values[match.group(1)], self.template)
+
+    async def prepare(self, prompt: str, token_counter: TokenCounter, deadline_seconds: float | None = None) -> tuple[str, bool]:
+        """
+        Returns the prompt line to send to the model and whether it was truncated. Raises a 413 if the prompt (after
+        truncation) is estimated to take longer to prefill than the deadline of the client allows. Without a token
+        budget and a deadline (or prefill rate), the tokenizer is not asked at all
+        """
+        prompt = self.to_line(prompt)
+        prompt_line = self.render(prompt)
+        if self.max_prompt_tokens is None and (deadline_seconds is None or self.prefill_tokens_per_second is None):
+            return prompt_line, False
+        token_count = await token_counter.count(prompt_line)
+        if token_count is None:
+            # Without the tokenizer the prompt can't be measured, the model can't run without it anyway
+            return prompt_line, False
+        truncated = self.max_prompt_tokens is not None and token_count > self.max_prompt_tokens
+        if truncated:
+            prompt_line, token_count = await self.__truncate(prompt, token_count, token_counter)
+        estimated_prefill_seconds = self.estimate_prefill_seconds(token_count)
+        if deadline_seconds is not None and estimated_prefill_seconds is not None and estimated_prefill_seconds > deadline_seconds:
+            raise HTTPException(status_code=413, detail=f"The prompt has {token_count} tokens, its prefill takes about "
+                f"{estimated_prefill_seconds:.1f}s which exceeds the deadline of {deadline_seconds:.1f}s")
+        return prompt_line, truncated
+
+    async def __truncate(self, prompt: str, token_count: int, token_counter: TokenCounter) -> tuple[str, int]:
+        # The tokenizer only encodes, so the prompt is cut in proportion to its tokens until it fits
+        template_tokens = await token_counter.count(self.render("")) or 0
+        if template_tokens >= self.max_prompt_tokens:
+            raise HTTPException(status_code=413, detail=f"The template of the model alone has {template_tokens} tokens, "
+                f"which exceeds the budget of {self.max_prompt_tokens} tokens")
+        original_token_count = token_count
+        keep_chars = len(prompt)
+        for _ in range(MAX_TRUNCATE_ATTEMPTS):
+            # Aim a bit below the budget, tokens are not spread evenly over the prompt
+            ratio = (self.max_prompt_tokens - template_tokens) / max(token_count - template_tokens, 1)
+            keep_chars = min(int(keep_chars * ratio * 0.95), keep_chars - 1)
+            if keep_chars <= 0:
+                break
+            truncated = prompt[-keep_chars:] if self.truncate_side == "start" else prompt[:keep_chars]
+            prompt_line = self.render(truncated.strip())
+            token_count = await token_counter.count(prompt_line)
+            if token_count is None:
+                break
+            if token_count <= self.max_prompt_tokens:
+                logger.info(f"Prompt truncated from {original_token_count} to {token_count} tokens (budget {self.max_prompt_tokens})")
+                return prompt_line, token_count
+        raise HTTPException(status_code=413, detail=f"The prompt has {original_token_count} tokens and could not be "
+            f"truncated to the budget of {self.max_prompt_tokens} tokens")
+
+    def estimate_prefill_seconds(self, token_count: int) -> float | None:
+        if not self.prefill_tokens_per_second:
+            return None
+        return token_count / self.prefill_tokens_per_second
+
+    def record_prefill(self, token_count: int, prefill_seconds: float):
+        """
+        Learns the prefill rate from an answered prompt
+        """
+        if not self.learn_prefill_rate or token_count < MIN_PREFILL_TOKENS_TO_LEARN or prefill_seconds <= 0:
+            return
+        rate = token_count / prefill_seconds
+        if self.prefill_tokens_per_second is None:
+            self.prefill_tokens_per_second = rate
+        else:
+            self.prefill_tokens_per_second += PREFILL_RATE_SMOOTHING * (rate - self.prefill_tokens_per_second)
@@ -0,0 +1,101 @@
+import asyncio
+import logging
+import math
+import time
+from collections import deque
+from fastapi import HTTPException
+
+logger = logging.getLogger("uvicorn.error")
+logger.setLevel(logging.DEBUG)
+
+DEFAULT_MAX_QUEUE_DEPTH = 8
+DEFAULT_QUEUE_TIME_OUT_SECONDS = 300
+# Weight of the latest prompt duration for the estimated duration of a prompt (used for the 'Retry-After' header)
+SERVICE_TIME_WEIGHT = 0.2
+
+
+# Serializes the prompts of one model, since the model process can only answer one prompt at a time.
+# Prompts are served first-in-first-out. If too many prompts are already waiting, new ones are rejected right away
+class RequestScheduler:
+
+    def __init__(self, model_name: str, max_queue_depth: int = DEFAULT_MAX_QUEUE_DEPTH,
+        queue_timeout: float = DEFAULT_QUEUE_TIME_OUT_SECONDS):
+        self.model_name = model_name
+        self.max_queue_depth = max_queue_depth
+        self.queue_timeout = queue_timeout
+        # One future per waiting prompt. Releasing the model hands it over to the oldest one
+        self.waiting = deque()
+        self.busy = False
+        self.acquired_at = None
+        self.avg_service_time = None
+
+    async def acquire(self, deadline_seconds: float | None = None) -> float:
+        """
+        Waits until it's the callers turn to prompt the model and returns the time waited in seconds.
+        Raises a 429 if the queue is full or a 503 if the caller's turn did not come within the deadline
+        """
+        timeout = deadline_seconds if deadline_seconds is not None else self.queue_timeout
+        start_time = time.monotonic()
+        if not self.busy and not self.waiting:
+            self.__grant()
+            return 0
+        if len(self.waiting) >= self.max_queue_depth:
+            logger.warning(f"Queue of model '{self.model_name}' is full ({len(self.waiting)} waiting)")
+            raise self.__unavailable(429, f"Too many prompts waiting for model '{self.model_name}'")
+
+        turn = asyncio.get_running_loop().create_future()
+        self.waiting.append(turn)
+        try:
+            await asyncio.wait_for(asyncio.shield(turn), timeout=timeout)
+        except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+            if turn.done() and not turn.cancelled():
+                # The turn came just now, pass it on to the next one
+                self.release()
+            else:
+                turn.cancel()
+                self.waiting.remove(turn)
+            if isinstance(e, asyncio.CancelledError):
+                raise
+            raise self.__unavailable(503, f"Model '{self.model_name}' did not become available within {timeout}s")
+        return time.monotonic() - start_time
+
+    def try_acquire(self) -> bool:
+        """
+        Takes the model right away if it's free and no prompt is waiting, without waiting otherwise
+        """
+        if self.busy or self.waiting:
+            return False
+        self.__grant()
+        return True
+
+    def release(self):
+        if not self.busy:
+            return
+        service_time = time.monotonic() - self.acquired_at
+        if self.avg_service_time is None:
+            self.avg_service_time = service_time
+        else:
+            self.avg_service_time += SERVICE_TIME_WEIGHT * (service_time - self.avg_service_time)
+        self.busy = False
+        while self.waiting:
+            turn = self.waiting.popleft()
+            if not turn.done():
+                self.__grant()
+                turn.set_result(None)
+                return
+
+    def get_queue_depth(self) -> int:
+        return len(self.waiting)
+
+    def get_load(self) -> int:
+        # Prompts waiting plus the one being answered
+        return len(self.waiting) + (1 if self.busy else 0)
+
+    def __grant(self):
+        self.busy = True
+        self.acquired_at = time.monotonic()
+
+    def __unavailable(self, status_code: int, detail: str) -> HTTPException:
+        # Estimate when the caller could be served: every prompt waiting (+ the one being answered) takes about that long
+        retry_after = (len(self.waiting) + 1) * (self.avg_service_time or 1)
+        return HTTPException(status_code=status_code, detail=detail, headers={"Retry-After": str(math.ceil(retry_after))})
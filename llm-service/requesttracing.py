@@ -0,0 +1,86 @@
+import os
+import time
+import uuid
+from collections import deque
+from datetime import datetime, timezone
+
+# Requests which took at least that long are kept for /api/debug/slow_requests
+SLOW_REQUEST_SECONDS = float(os.environ.get("SLOW_REQUEST_SECONDS", "10"))
+MAX_SLOW_REQUESTS = int(os.environ.get("MAX_SLOW_REQUESTS", "100"))
+
+
+# Follows one request through the llm-service. The stages of its prompt (queue, model start, readiness, stdin write,
+# prefill, decode..) are recorded by the LlmService into the sink of the prompt, the trace refers to them. Prompts
+# which join an identical prompt in flight share its stages
+class RequestTrace:
+
+    def __init__(self, model_name: str, endpoint: str, request_id: str | None = None):
+        self.request_id = request_id or uuid.uuid4().hex
+        self.model_name = model_name
+        self.endpoint = endpoint
+        self.created_at = datetime.now(timezone.utc).isoformat()
+        self.start_time = time.monotonic()
+        self.end_time = None
+        # Replicas the prompt was sent to, more than one if it failed over
+        self.replicas = []
+        # Stage -> seconds
+        self.timings = {}
+        self.cached = False
+        self.error = None
+
+    def attach(self, replica_name: str, timings: dict | None = None):
+        """
+        The prompt is handled by the given replica, which records the stages into the given timings
+        """
+        self.replicas.append(replica_name)
+        self.timings = timings if timings is not None else {}
+
+    def finish(self, error: Exception | None = None):
+        # A streamed request is done with the last chunk, even if the client reads it later
+        if self.end_time is None:
+            self.end_time = time.monotonic()
+        if error is not None:
+            self.error = str(getattr(error, "detail", None) or error)
+
+    def get_total_seconds(self) -> float:
+        return (self.end_time or time.monotonic()) - self.start_time
+
+    def get_timings(self) -> dict:
+        # Stages in seconds, rounded to milliseconds
+        timings = {stage: round(seconds, 3) for stage, seconds in self.timings.items()}
+        timings["total"] = round(self.get_total_seconds(), 3)
+        return timings
+
+    def to_server_timing(self, include_total: bool = True) -> str:
+        # Server-Timing header (https://www.w3.org/TR/server-timing/), durations in milliseconds. Without the total
+        # for a streamed answer, whose header is sent before the model has answered
+        timings = {**self.timings, "total": self.get_total_seconds()} if include_total else self.timings
+        return ", ".join(f"{stage};dur={seconds * 1000:.1f}" for stage, seconds in timings.items())
+
+    def to_dict(self) -> dict:
+        return {
+            "request_id": self.request_id,
+            "model": self.model_name,
+            "endpoint": self.endpoint,
+            "created_at": self.created_at,
+            "replicas": self.replicas,
+            "cached": self.cached,
+            "error": self.error,
+            "timings": self.get_timings()
+        }
+
+
+# Keeps the traces of the most recent slow requests, the oldest ones are dropped first
+class SlowRequests:
+
+    def __init__(self, threshold_seconds: float = SLOW_REQUEST_SECONDS, max_requests: int = MAX_SLOW_REQUESTS):
+        self.threshold_seconds = threshold_seconds
+        self.traces = deque(maxlen=max_requests)
+
+    def record(self, trace: RequestTrace):
+        if trace.get_total_seconds() >= self.threshold_seconds:
+            self.traces.append(trace)
+
+    def get_requests(self) -> list[dict]:
+        # Most recent first
+        return [trace.to_dict() for trace in reversed(self.traces)]
@@ -0,0 +1,112 @@
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+
+logger = logging.getLogger("uvicorn.error")
+logger.setLevel(logging.DEBUG)
+
+DEFAULT_MAX_ENTRIES = 256
+DEFAULT_MAX_BYTES = 16 * 1024 * 1024
+DEFAULT_TTL_SECONDS = 3600
+
+
+# Caches the answers of a model. The least recently used answers are evicted as soon as there are too many of them
+# (or they're too large) and answers expire after the ttl. Optionally, the answers are persisted as json file
+class ResponseCache:
+
+    def __init__(self, max_entries: int = DEFAULT_MAX_ENTRIES, max_bytes: int = DEFAULT_MAX_BYTES,
+        ttl_seconds: float = DEFAULT_TTL_SECONDS, persist_path: str | None = None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self.persist_path = persist_path
+        self.persist_lock = threading.Lock()
+        self.version = 0
+        self.persisted_version = 0
+        # key -> (response, expires_at). Wall clock time, so it stays valid when persisted
+        self.entries = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        if persist_path:
+            self.__load()
+
+    @staticmethod
+    def create_key(model_name: str, prompt: str, options: dict | None, include_thinking: str) -> str:
+        # Whitespace does not change the meaning of a prompt, so differently formatted prompts share their answer
+        normalized_prompt = " ".join(prompt.split())
+        key = json.dumps([model_name, normalized_prompt, options or {}, include_thinking.lower()], sort_keys=True)
+        return hashlib.sha256(key.encode()).hexdigest()
+
+    def get(self, key: str) -> str | None:
+        entry = self.entries.get(key)
+        if entry is None or entry[1] < time.time():
+            if entry is not None:
+                self.__remove(key)
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return entry[0]
+
+    def put(self, key: str, response: str):
+        if self.__get_size(response) > self.max_bytes:
+            return
+        if key in self.entries:
+            self.__remove(key)
+        self.entries[key] = (response, time.time() + self.ttl_seconds)
+        self.size += self.__get_size(response)
+        self.__evict()
+        if self.persist_path:
+            # Don't block the event loop with writing the file
+            self.version += 1
+            snapshot = list(self.entries.items())
+            asyncio.get_running_loop().run_in_executor(None, self.__persist, snapshot, self.version)
+
+    def __evict(self):
+        while len(self.entries) > self.max_entries or self.size > self.max_bytes:
+            self.__remove(next(iter(self.entries)))
+
+    def __remove(self, key: str):
+        response, _ = self.entries.pop(key)
+        self.size -= self.__get_size(response)
+
+    @staticmethod
+    def __get_size(response: str) -> int:
+        # The limit is in bytes, answers may well contain non-ascii characters
+        return len(response.encode())
+
+    def __persist(self, snapshot: list, version: int):
+        with self.persist_lock:
+            # A newer snapshot may have been written in the meantime
+            if version < self.persisted_version:
+                return
+            self.persisted_version = version
+            try:
+                # Write to a temp file first, so the cache file is never half written
+                tmp_path = f"{self.persist_path}.tmp"
+                with open(tmp_path, "w") as file:
+                    json.dump([[key, response, expires_at] for key, (response, expires_at) in snapshot], file)
+                os.replace(tmp_path, self.persist_path)
+            except Exception as e:
+                logger.error(f"Error while persisting response cache to '{self.persist_path}'! {repr(e)}")
+
+    def __load(self):
+        if not os.path.exists(self.persist_path):
+            return
+        try:
+            with open(self.persist_path, "r") as file:
+                now = time.time()
+                for key, response, expires_at in json.load(file):
+                    if expires_at > now:
+                        self.entries[key] = (response, expires_at)
+                        self.size += self.__get_size(response)
+            self.__evict()
+            logger.info(f"Loaded {len(self.entries)} cached responses from '{self.persist_path}'")
+        except Exception as e:
+            logger.error(f"Error while loading response cache from '{self.persist_path}'! {repr(e)}")
@@ -0,0 +1,116 @@
+import asyncio
+import logging
+import time
+
+logger = logging.getLogger("uvicorn.error")
+logger.setLevel(logging.DEBUG)
+
+# Max. number of characters kept of one answer. Everything beyond is dropped (but still streamed)
+MAX_RESPONSE_CHARS = 256 * 1024
+
+
+# Collects the answer of exactly one prompt. The llm output handler writes the lines of the answer into the sink
+# of the prompt which is currently answered and closes it as soon as the model is done.
+# Any number of clients can wait for or stream the answer (identical prompts share one sink)
+class ResponseSink:
+
+    def __init__(self, max_chars: int = MAX_RESPONSE_CHARS):
+        self.lines_written = []
+        self.max_chars = max_chars
+        self.size = 0
+        self.truncated = False
+        self.line_count = 0
+        self.queue_wait = 0
+        self.prompt = None
+        # Set if the prompt is a rendered conversation
+        self.messages = None
+        # What was sent to the model, only the new turn if the conversation was continued
+        self.prompt_line = None
+        # Token counts and the model's avg token/s, set once the model has answered. 'counted' is done as soon as
+        # the token counts are there
+        self.prompt_eval_count = 0
+        self.eval_count = 0
+        self.avg_token_per_second = None
+        self.counted = None
+        # Set if the answer should be cached
+        self.cache_key = None
+        # Identifies the prompt, so identical prompts can join this sink while it's in flight
+        self.flight_key = None
+        # Task which queues and sends the prompt, all clients of this sink wait for it
+        self.sent = None
+        # Requests waiting for this answer, for the logs
+        self.request_ids = []
+        # Clients waiting for the prompt to be sent. If all of them are gone while it's queued, it's not sent at all
+        self.waiters = 0
+        # Stage of the prompt (queue, readiness, prefill..) -> seconds, see RequestTrace
+        self.timings = {}
+        self.created_time = time.monotonic()
+        self.start_time = None
+        self.sent_time = None
+        self.first_line_time = None
+        self.end_time = None
+        # Set if the model could not answer, e.g. because it crashed. Raised to every client of this sink
+        self.error = None
+        self.answered = asyncio.get_running_loop().create_future()
+        self.subscribers = []
+
+    def write(self, line: str):
+        if self.first_line_time is None:
+            self.first_line_time = time.monotonic()
+        self.line_count += 1
+        for subscriber in self.subscribers:
+            subscriber.put_nowait(line)
+        if self.size + len(line) > self.max_chars:
+            if not self.truncated:
+                logger.warning(f"Answer exceeds {self.max_chars} characters, dropping the rest")
+                self.truncated = True
+            return
+        self.lines_written.append(line)
+        self.size += len(line)
+
+    def close(self):
+        self.end_time = time.monotonic()
+        for subscriber in self.subscribers:
+            subscriber.put_nowait(None)
+        if not self.answered.done():
+            self.answered.set_result(None)
+
+    def fail(self, error: Exception):
+        self.error = error
+        self.close()
+
+    async def wait(self, timeout: float) -> bool:
+        try:
+            await asyncio.wait_for(asyncio.shield(self.answered), timeout=timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+
+    async def lines(self, timeout: float):
+        """
+        Yields each line of the answer as soon as it's written (starting with the lines written so far),
+        until the sink is closed. Raises a TimeoutError if there was no line for the given time and the error
+        of the sink if it failed
+        """
+        subscriber = asyncio.Queue()
+        for line in self.lines_written:
+            subscriber.put_nowait(line)
+        if self.answered.done():
+            subscriber.put_nowait(None)
+        self.subscribers.append(subscriber)
+        try:
+            while True:
+                try:
+                    line = await asyncio.wait_for(subscriber.get(), timeout=timeout)
+                except asyncio.TimeoutError:
+                    raise TimeoutError(f"No answer within {timeout}s")
+                if line is None:
+                    if self.error is not None:
+                        raise self.error
+                    return
+                yield line
+        finally:
+            self.subscribers.remove(subscriber)
+
+    def getvalue(self) -> str:
+        return "".join(self.lines_written)
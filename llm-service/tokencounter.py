@@ -0,0 +1,51 @@
+import asyncio
+import hashlib
+import logging
+import requests
+from collections import OrderedDict
+
+logger = logging.getLogger("uvicorn.error")
+logger.setLevel(logging.DEBUG)
+
+# Endpoint of the tokenizer server of a model (started by the tokenizer-service), which turns a text into token ids
+TOKENIZER_ENCODE_API = "http://{0}:{1}/encode"
+TOKENIZER_ENCODE_TIME_OUT_SECONDS = 10
+# Max. number of texts (e.g. prompts) whose token count is kept
+MAX_CACHED_COUNTS = 1024
+
+
+# Counts the tokens of a text with the tokenizer of the model, so the counts are exactly what the model sees
+# (whitespace splitting is way off for code or CJK). Counts of repeated texts are cached
+class TokenCounter:
+
+    def __init__(self, tokenizer_ip: str, tokenizer_port: int, max_cached_counts: int = MAX_CACHED_COUNTS):
+        self.encode_api = TOKENIZER_ENCODE_API.format(tokenizer_ip, tokenizer_port)
+        self.max_cached_counts = max_cached_counts
+        # text hash -> token count
+        self.counts = OrderedDict()
+        self.session = requests.Session()
+
+    async def count(self, text: str, cache: bool = True) -> int | None:
+        """
+        Returns the number of tokens of the given text, or None if the tokenizer could not be asked
+        """
+        key = hashlib.sha256(text.encode()).hexdigest() if cache else None
+        token_count = self.counts.get(key) if cache else None
+        if token_count is not None:
+            self.counts.move_to_end(key)
+            return token_count
+        try:
+            token_count = await asyncio.to_thread(self.__encode, text)
+        except Exception as e:
+            logger.warning(f"Could not count tokens with the tokenizer at {self.encode_api}! {repr(e)}")
+            return None
+        if cache:
+            self.counts[key] = token_count
+            if len(self.counts) > self.max_cached_counts:
+                self.counts.popitem(last=False)
+        return token_count
+
+    def __encode(self, text: str) -> int:
+        response = self.session.post(self.encode_api, json={"text": text}, timeout=TOKENIZER_ENCODE_TIME_OUT_SECONDS)
+        response.raise_for_status()
+        return len(response.json()["token_ids"])
@@ -5,12 +5,19 @@ sleep 4
 echo "LLM init ok"
 sleep 2
 echo "Type q to exit"
-# Read from stdin in a loop
+# Read from stdin in a loop. Like a model which keeps its context, it counts the turns until it's reset
+turn=0
 while true; do
   read -r user_input
   if [[ "$user_input" == "q" || "$user_input" == "Q" ]]; then
     break
   fi
+  if [[ "$user_input" == "reset" ]]; then
+    turn=0
+    echo "hit eos"
+    continue
+  fi
+  turn=$((turn + 1))
   sleep 2
   echo "<think>Alright user asked me a very important question. How should I response?"
   sleep 2
@@ -22,6 +29,6 @@ while true; do
   sleep 2
   echo "No wait, thats crap. The answer is: hallelujah"
   sleep 2
-  echo "Nope! wait, ok I've got it: My final answer is </think> The answer is 42: $user_input"
+  echo "Nope! wait, ok I've got it: My final answer is </think> The answer is 42 (turn $turn): $user_input"
   echo "hit eos,avg 4.22 token/s"
 done
\ No newline at end of file
@@ -1,16 +1,44 @@
 #!/usr/bin/env python3
 
+import argparse
+import json
 import logging
+import re
+from http.server import BaseHTTPRequestHandler, HTTPServer
 from time import sleep
 
 logger = logging.getLogger("uvicorn.error")
 logger.setLevel(logging.DEBUG)
 
+class DummyTokenizerHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        self.send_response(200)
+        self.end_headers()
+
+    def do_POST(self):
+        # Like the tokenizers of the real models: each word and each punctuation mark is one token
+        if self.path != "/encode":
+            self.send_response(404)
+            self.end_headers()
+            return
+        text = json.loads(self.rfile.read(int(self.headers["Content-Length"])))["text"]
+        token_ids = [hash(token) % 32000 for token in re.findall(r"\w+|[^\w\s]", text)]
+        body = json.dumps({"token_ids": token_ids}).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
 def main():
-    print("Dummy-Tokenizer: Dummy tokenizer started")
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--port", type=int, default=5110)
+    args = parser.parse_args()
+    print("Dummy-Tokenizer: Dummy tokenizer started", flush=True)
     sleep(2)
-    print("Dummy-Tokenizer: Models won't be available and only tokenizers")
+    print("Dummy-Tokenizer: Models won't be available and only tokenizers", flush=True)
     sleep(2)
-    print("Dummy-Tokenizer: Server @127.0.0.1:5110")
+    print(f"Dummy-Tokenizer: Server @127.0.0.1:{args.port}", flush=True)
+    HTTPServer(("127.0.0.1", args.port), DummyTokenizerHandler).serve_forever()
 
-if __name__ == "__main__":main()
\ No newline at end of file
+if __name__ == "__main__":main()
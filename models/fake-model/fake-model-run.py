@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+"""
+Simulates an AX-M1 model in live_print mode, so the llm-service can be load tested without an npu.
+Prints the init lines of the real runtime, then reads one prompt per line from stdin and answers it token by token
+at the configured rate, followed by 'hit eos,avg .. token/s'. 'q' quits, 'reset' drops the context
+(acknowledged with 'hit eos').
+
+Configured by environment variables (inherited from the llm-service) or the corresponding arguments:
+FAKE_MODEL_INIT_SECONDS, FAKE_MODEL_TTFT_MS, FAKE_MODEL_TOKENS_PER_SECOND, FAKE_MODEL_ANSWER_TOKENS,
+FAKE_MODEL_THINKING_TOKENS, FAKE_MODEL_CRASH_RATE
+
+Usage: fake-model-run.py <tokenizer port> [--tokens-per-second <n>] [--answer-tokens <n>] ..
+"""
+import argparse
+import os
+import random
+import sys
+import time
+
+# Answers are made of these tokens, like the real model prints them (leading space, words split into pieces)
+THINKING_TOKENS = ["Okay", ",", " the", " user", " wants", " me", " to", " descr", "ibe", " the", " event", " captu", "red",
+    " by", " the", " camer", "a", "."]
+TOKENS = [" A", " person", " walki", "ng", " up", " the", " drive", "way", " carries", " a", " packa", "ge", " to", " the",
+    " front", " door", "."]
+
+
+def env(name: str, default: str) -> str:
+    return os.environ.get(f"FAKE_MODEL_{name}", default)
+
+
+def print_line(line: str):
+    sys.stdout.write(line + "\n")
+    sys.stdout.flush()
+
+
+def init(args):
+    print_line("[I][                            Init][ 136]: LLM init start")
+    print_line(f"[I][                            Init][  34]: connect http://127.0.0.1:{args.tokenizer_port} ok")
+    time.sleep(args.init_seconds)
+    print_line("[I][                            Init][ 292]: max_token_len : 1023")
+    print_line("[I][                            Init][ 327]: LLM init ok")
+    print_line('Type "q" to exit, Ctrl+c to stop current running')
+
+
+def answer(args, prompt: str, turn: int):
+    time.sleep(args.ttft_ms / 1000)
+    print_line(f"[I][                             Run][ 626]: ttft: {args.ttft_ms:.2f} ms")
+    if random.random() < args.crash_rate:
+        print_line("Segmentation fault")
+        sys.exit(139)
+    tokens = [TOKENS[index % len(TOKENS)] for index in range(args.answer_tokens)]
+    if args.thinking_tokens > 0:
+        tokens = ["<think>"] + [THINKING_TOKENS[index % len(THINKING_TOKENS)] for index in range(args.thinking_tokens)] + \
+            ["</think>"] + tokens
+    tokens.append(f" (turn {turn}: {len(prompt)} chars)")
+    token_interval = 1 / args.tokens_per_second
+    first_token_time = time.monotonic()
+    for index, token in enumerate(tokens):
+        print_line(token)
+        # Sleep until the next token is due, so the rate does not drift with the time spent printing
+        next_token_time = first_token_time + (index + 1) * token_interval
+        time.sleep(max(0, next_token_time - time.monotonic()))
+    avg_token_per_second = len(tokens) / max(time.monotonic() - first_token_time, 1e-9)
+    print_line(f"[N][                             Run][ 756]: hit eos,avg {avg_token_per_second:.2f} token/s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("tokenizer_port", nargs="?", default="8080")
+    parser.add_argument("--init-seconds", type=float, default=float(env("INIT_SECONDS", "1")))
+    parser.add_argument("--ttft-ms", type=float, default=float(env("TTFT_MS", "200")))
+    parser.add_argument("--tokens-per-second", type=float, default=float(env("TOKENS_PER_SECOND", "20")))
+    parser.add_argument("--answer-tokens", type=int, default=int(env("ANSWER_TOKENS", "64")))
+    parser.add_argument("--thinking-tokens", type=int, default=int(env("THINKING_TOKENS", "0")),
+        help="tokens between <think> and </think> before the answer")
+    parser.add_argument("--crash-rate", type=float, default=float(env("CRASH_RATE", "0")),
+        help="probability that the model crashes while answering a prompt")
+    args = parser.parse_args()
+
+    init(args)
+    turn = 0
+    for line in sys.stdin:
+        prompt = line.strip()
+        if prompt in ("q", "Q"):
+            break
+        if prompt == "reset":
+            turn = 0
+            print_line("hit eos")
+            continue
+        turn += 1
+        answer(args, prompt, turn)
+
+
+if __name__ == "__main__":main()
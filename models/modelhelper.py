@@ -1,13 +1,35 @@
+import asyncio
 import json
 import logging
-from llmservice import LlmService
+import os
+import time
+from chatsessions import DEFAULT_MAX_SESSIONS, DEFAULT_RESET_ACK, DEFAULT_RESET_CMD, DEFAULT_SESSION_TTL_SECONDS, ChatSessions
+from llmrouter import LlmRouter
+from llmservice import READINESS_TIME_OUT_SECONDS, TOKENIZER_REQUEST_TIME_OUT_SECONDS, LlmService, LlmStatus, tokenizer_session
+from promptpipeline import DEFAULT_NEWLINE_MODE, DEFAULT_TRUNCATE_SIDE, PromptPipeline
+from requestscheduler import DEFAULT_MAX_QUEUE_DEPTH, DEFAULT_QUEUE_TIME_OUT_SECONDS
+from responsecache import DEFAULT_MAX_BYTES, DEFAULT_MAX_ENTRIES, DEFAULT_TTL_SECONDS, ResponseCache
 from tokenizerservice import TokenizerService
 
 logger = logging.getLogger("uvicorn.error")
 logger.setLevel(logging.DEBUG)
 
+# How many models may start (= initialize on the npu) at the same time. Depends on the npu memory
+STARTUP_PARALLELISM = int(os.environ.get("LLM_STARTUP_PARALLELISM", "1"))
+# Npu memory available for all running models (see 'npu_memory_mb' of the model-descriptors). 0 means no limit
+NPU_MEMORY_BUDGET_MB = int(os.environ.get("NPU_MEMORY_BUDGET_MB", "0"))
+IDLE_CHECK_INTERVAL_SECONDS = 10
+# Max. time to wait for a running model to become free, so it can be stopped in favor of another one
+SWAP_TIME_OUT_SECONDS = 300
+SWAP_RETRY_INTERVAL_SECONDS = 0.5
+MODEL_DESCRIPTORS_PATH = "/app/models/model-descriptors.json"
+# The model-descriptors are checked for changes that often (0 = only reloaded by /api/admin/reload_models)
+MODEL_DESCRIPTORS_CHECK_INTERVAL_SECONDS = float(os.environ.get("MODEL_DESCRIPTORS_CHECK_INTERVAL_SECONDS", "10"))
+TOKENIZER_RELOAD_API = "http://{0}:8101/reload"
+
 # Contains all available models (aka model-descriptors) as well as all running models (aka LlmService)
-# At the moment the model-descriptors are cached, so adding new models require a restart of the docker services
+# If the model-descriptors change, only the models which were added, changed or removed are (re)created resp. stopped.
+# The other models keep running
 class ModelHelper():
 
 
@@ -17,56 +39,446 @@ class ModelHelper():
         return cls.instance
 
     def __init__(self):
+        # Replica name -> llm-service resp. tokenizer-service. The first replica of a model is named like the model
         self.name_to_llm_services = {}
         self.name_to_tokenizer_services = {}
+        # Model name -> router to the replicas of the model
+        self.name_to_llm_routers = {}
         self.model_descriptors = None
+        self.model_descriptors_mtime = None
+        # Replica name -> model-descriptor of the replica
+        self.replica_descriptors = {}
+        # Only one model is started or stopped on demand at a time
+        self.swap_lock = asyncio.Lock()
+        # Only one reload of the model-descriptors at a time
+        self.reload_lock = asyncio.Lock()
+        self.reload_startup_task = None
+        # Llm-service -> event which is set once the model may be started: the replicas of a reloaded model replace
+        # running ones, which have to be stopped first (and it's started by the reload if it runs on startup)
+        self.pending_starts = {}
+        # Response of /api/tags, built once per version of the model-descriptors
+        self.tags = None
 
-    def __read_model_descriptors(self):
-        with open("/app/models/model-descriptors.json", "r") as file:
-            self.model_descriptors = json.load(file)
+    def __read_model_descriptors(self) -> list[dict]:
+        self.model_descriptors_mtime = os.stat(MODEL_DESCRIPTORS_PATH).st_mtime
+        with open(MODEL_DESCRIPTORS_PATH, "r") as file:
+            return json.load(file)
 
 
     def create_tokenizer_services(self):
         if self.model_descriptors == None:
-            self.__read_model_descriptors()
+            self.model_descriptors = self.__read_model_descriptors()
         for model_desc in self.model_descriptors:
-            model_name = model_desc["model_name"]
-            self.name_to_tokenizer_services.setdefault(model_name, TokenizerService(model_desc["tokenizer_py"],
-                model_desc["tokenizer_path"], int(model_desc["tokenizer_port"])))
-            logger.info(f"Created tokenizer-service for model '{model_name}'")
+            self.__create_tokenizer_services(model_desc)
+
+    def __create_tokenizer_services(self, model_desc):
+        for replica_name, replica_desc in self.__get_replica_descriptors(model_desc):
+            shared = replica_desc.get("share_tokenizer", "true").lower() == "true"
+            tokenizer_service = self.__find_shared_tokenizer_service(replica_desc) if shared else None
+            if tokenizer_service is None:
+                tokenizer_service = TokenizerService(replica_desc["tokenizer_py"], replica_desc["tokenizer_path"],
+                    int(replica_desc["tokenizer_port"]), shared)
+                logger.info(f"Created tokenizer-service for model '{replica_name}'")
+            else:
+                logger.info(f"Model '{replica_name}' shares the tokenizer at port {tokenizer_service.port}")
+            tokenizer_service.users.add(replica_name)
+            self.name_to_tokenizer_services.setdefault(replica_name, tokenizer_service)
+            self.replica_descriptors[replica_name] = replica_desc
+
+    def __find_shared_tokenizer_service(self, replica_desc) -> TokenizerService | None:
+        # Models with the same tokenizer files can use the same tokenizer process
+        for tokenizer_service in self.name_to_tokenizer_services.values():
+            if tokenizer_service.shared and tokenizer_service.tokenizer_path == replica_desc["tokenizer_path"] \
+                and tokenizer_service.tokenizer_py == replica_desc["tokenizer_py"]:
+                return tokenizer_service
+        return None
 
     def create_llm_services(self):
         if self.model_descriptors == None:
-            self.__read_model_descriptors()
+            self.model_descriptors = self.__read_model_descriptors()
         for model_desc in self.model_descriptors:
-            model_name = model_desc["model_name"]
-            llm_service = LlmService(model_name, model_desc["run_cmd"], model_desc["model_path"], model_desc["tokenizer_ip"],
-                 model_desc["tokenizer_py"], model_desc["tokenizer_path"], int(model_desc["tokenizer_port"]),
-                 model_desc["include_thinking"])
-            self.name_to_llm_services.setdefault(model_name, llm_service)
-            logger.info(f"Created llm-service for model '{model_name}'")
+            self.__add_llm_router(*self.__create_llm_router(model_desc))
+
+    def __create_llm_router(self, model_desc) -> tuple[LlmRouter, dict]:
+        """
+        Creates the replicas of the model and returns their router and descriptors. Nothing is registered yet, so a
+        faulty descriptor (e.g. without 'run_cmd') raises before the models in use are touched
+        """
+        model_name = model_desc["model_name"]
+        # The replicas share the answers, but each one has its own context
+        response_cache = self.__create_response_cache(model_desc)
+        replicas = []
+        replica_descriptors = {}
+        try:
+            for replica_name, replica_desc in self.__get_replica_descriptors(model_desc):
+                llm_service = LlmService(model_name, replica_desc["run_cmd"], replica_desc["model_path"],
+                    replica_desc["tokenizer_ip"], replica_desc["tokenizer_py"], replica_desc["tokenizer_path"],
+                    int(replica_desc["tokenizer_port"]), replica_desc["include_thinking"],
+                    int(replica_desc.get("max_queue_depth", DEFAULT_MAX_QUEUE_DEPTH)),
+                    float(replica_desc.get("queue_timeout_seconds", DEFAULT_QUEUE_TIME_OUT_SECONDS)),
+                    response_cache, self.__create_chat_sessions(replica_desc), replica_name, replica_desc.get("device"),
+                    self.__create_prompt_pipeline(replica_desc))
+                replicas.append(llm_service)
+                replica_descriptors[replica_name] = replica_desc
+        except Exception:
+            self.__discard_llm_services(replicas)
+            raise
+        return LlmRouter(model_name, replicas), replica_descriptors
+
+    def __add_llm_router(self, router: LlmRouter, replica_descriptors: dict):
+        for llm_service in router.replicas:
+            llm_service.lifecycle_manager = self
+            self.name_to_llm_services.setdefault(llm_service.replica_name, llm_service)
+            self.replica_descriptors[llm_service.replica_name] = replica_descriptors[llm_service.replica_name]
+            logger.info(f"Created llm-service for model '{llm_service.replica_name}'")
+        self.name_to_llm_routers.setdefault(router.model_name, router)
+
+    def __discard_llm_services(self, llm_services: list[LlmService]):
+        # Created but never registered (nor started), only their metrics collectors are registered. Their values
+        # are the ones of the replicas in use with the same name
+        for llm_service in llm_services:
+            llm_service.metrics.unregister(remove_values=False)
+
+    def __get_replica_descriptors(self, model_desc) -> list[tuple[str, dict]]:
+        """
+        Returns the name and the descriptor of each replica of the model. 'replicas' is either the number of replicas
+        (their tokenizer ports follow the one of the model) or a list of attributes which differ per replica
+        (e.g. 'tokenizer_port', 'tokenizer_ip' or 'device')
+        """
+        model_name = model_desc["model_name"]
+        replicas = model_desc.get("replicas", "1")
+        if isinstance(replicas, (str, int)):
+            replicas = [{"tokenizer_port": str(int(model_desc["tokenizer_port"]) + index)} for index in range(int(replicas))]
+        return [(model_name if index == 0 else f"{model_name}@{index}", {**model_desc, **replica_desc})
+            for index, replica_desc in enumerate(replicas)]
 
-    def start_default_llm_services(self):
+    def __create_response_cache(self, model_desc) -> ResponseCache | None:
+        cache_desc = model_desc.get("response_cache")
+        if cache_desc is None or cache_desc.get("enabled", "false").lower() != "true":
+            return None
+        return ResponseCache(int(cache_desc.get("max_entries", DEFAULT_MAX_ENTRIES)),
+            int(cache_desc.get("max_bytes", DEFAULT_MAX_BYTES)), float(cache_desc.get("ttl_seconds", DEFAULT_TTL_SECONDS)),
+            cache_desc.get("persist_path"))
+
+    def __create_chat_sessions(self, model_desc) -> ChatSessions:
+        sessions_desc = model_desc.get("chat_sessions", {})
+        context_continuation = sessions_desc.get("context_continuation", "false").lower() == "true"
+        if context_continuation and "prompt_pipeline" in model_desc:
+            # A continued conversation only sends the new turn, which would bypass the template and the token budget
+            logger.warning(f"Model '{model_desc['model_name']}' has a prompt_pipeline, so conversations are not continued")
+            context_continuation = False
+        return ChatSessions(context_continuation,
+            int(sessions_desc.get("max_sessions", DEFAULT_MAX_SESSIONS)),
+            float(sessions_desc.get("ttl_seconds", DEFAULT_SESSION_TTL_SECONDS)),
+            sessions_desc.get("reset_cmd", DEFAULT_RESET_CMD), sessions_desc.get("reset_ack", DEFAULT_RESET_ACK))
+
+    def __create_prompt_pipeline(self, model_desc) -> PromptPipeline:
+        # Each replica learns its own prefill rate (if enabled)
+        pipeline_desc = model_desc.get("prompt_pipeline", {})
+        max_prompt_tokens = pipeline_desc.get("max_prompt_tokens")
+        prefill_tokens_per_second = pipeline_desc.get("prefill_tokens_per_second")
+        return PromptPipeline(pipeline_desc.get("template"), pipeline_desc.get("system_prompt", ""),
+            pipeline_desc.get("newline_mode", DEFAULT_NEWLINE_MODE),
+            int(max_prompt_tokens) if max_prompt_tokens is not None else None,
+            pipeline_desc.get("truncate_side", DEFAULT_TRUNCATE_SIDE),
+            float(prefill_tokens_per_second) if prefill_tokens_per_second is not None else None,
+            pipeline_desc.get("learn_prefill_rate", "false").lower() == "true")
+
+    async def start_default_llm_services(self, model_descriptors: list[dict] | None = None):
+        """
+        Starts the models which should run on startup (of the given model-descriptors, all by default)
+        """
         if self.model_descriptors is None:
             self.create_llm_services()
-        for model_desc in self.model_descriptors:
+        startup_slots = asyncio.Semaphore(STARTUP_PARALLELISM)
+        startups = []
+        for model_desc in model_descriptors if model_descriptors is not None else self.model_descriptors:
             model_name = model_desc["model_name"]
             start_service = model_desc["run_on_startup"]
             if start_service.lower() == "true":
-                llm_service = self.name_to_llm_services[model_name]
-                logger.info(f"About to start llm-service '{model_name}' ({start_service})")
-                llm_service.start_model()
-                llm_service.await_readiness()
+                for llm_service in self.name_to_llm_routers[model_name].replicas:
+                    logger.info(f"About to start llm-service '{llm_service.replica_name}' ({start_service})")
+                    startups.append(self.__start_llm_service(llm_service, startup_slots))
+        await asyncio.gather(*startups)
+
+    async def __start_llm_service(self, llm_service: LlmService, startup_slots: asyncio.Semaphore):
+        # A prompt may have started the model in the meantime
+        if llm_service.get_status() != LlmStatus.IDLE:
+            return
+        try:
+            # All tokenizers start right away, only the models have to wait for a free slot
+            await llm_service.start_tokenizer()
+            # The slot is held until the model is ready or its process is gone, so a model whose initialization takes
+            # long or fails does not share the npu with the next one
+            async with startup_slots:
+                # Within the npu memory budget, like any other model start
+                async with self.swap_lock:
+                    await self.__make_room_for(llm_service)
+                    await llm_service.start_model_process()
+                if not await llm_service.await_startup(READINESS_TIME_OUT_SECONDS):
+                    logger.error(f"Model '{llm_service.replica_name}' did not become ready, status: {llm_service.get_status()}")
+        except Exception as e:
+            logger.error(f"Error while starting llm-service '{llm_service.replica_name}'! {repr(e)}")
+
+    # ---------------------------------------------
+    #               MODEL LIFECYCLE
+    # ---------------------------------------------
+    async def ensure_model_started(self, llm_service: LlmService):
+        """
+        Starts the given model if it's not running. If the npu memory budget does not allow it, the least recently
+        used models which are not busy are stopped first
+        """
+        pending_start = self.pending_starts.get(llm_service)
+        if pending_start is not None:
+            await pending_start.wait()
+        async with self.swap_lock:
+            if llm_service.get_status() != LlmStatus.IDLE:
+                return
+            await self.__make_room_for(llm_service)
+            await llm_service.start_model()
+
+    async def stop_idle_models(self):
+        """
+        Stops each model which was not used for longer than its 'keep_alive_seconds'
+        """
+        while True:
+            await asyncio.sleep(IDLE_CHECK_INTERVAL_SECONDS)
+            for replica_name, llm_service in list(self.name_to_llm_services.items()):
+                keep_alive = self.replica_descriptors[replica_name].get("keep_alive_seconds")
+                if keep_alive is None or llm_service.get_idle_seconds() < float(keep_alive):
+                    continue
+                async with self.swap_lock:
+                    if self.__is_stoppable(llm_service) and llm_service.scheduler.try_acquire():
+                        logger.info(f"Model '{replica_name}' was idle for {llm_service.get_idle_seconds():.0f}s")
+                        await self.__stop_llm_service(llm_service)
+
+    async def __make_room_for(self, llm_service: LlmService):
+        if NPU_MEMORY_BUDGET_MB <= 0:
+            return
+        required_memory = self.__get_npu_memory(llm_service)
+        deadline = time.monotonic() + SWAP_TIME_OUT_SECONDS
+        while self.__get_used_npu_memory(llm_service) + required_memory > NPU_MEMORY_BUDGET_MB:
+            victim = self.__take_least_recently_used(llm_service)
+            if victim is None:
+                # All running models are busy, wait until one of them is done
+                if time.monotonic() > deadline:
+                    raise TimeoutError(f"No npu memory available for model '{llm_service.replica_name}'")
+                await asyncio.sleep(SWAP_RETRY_INTERVAL_SECONDS)
+                continue
+            logger.info(f"Stopping model '{victim.replica_name}' in favor of model '{llm_service.replica_name}'")
+            await self.__stop_llm_service(victim)
+
+    def __take_least_recently_used(self, llm_service: LlmService) -> LlmService | None:
+        # Returns the least recently used model which is running but not busy. It's scheduler is taken, so no prompt
+        # can be sent to it until it's stopped
+        candidates = [candidate for candidate in self.name_to_llm_services.values()
+            if candidate is not llm_service and self.__is_stoppable(candidate)]
+        for candidate in sorted(candidates, key=lambda candidate: candidate.last_used_at):
+            if candidate.scheduler.try_acquire():
+                return candidate
+        return None
+
+    async def __stop_llm_service(self, llm_service: LlmService):
+        try:
+            await llm_service.stop_model()
+        finally:
+            llm_service.scheduler.release()
+
+    def __is_stoppable(self, llm_service: LlmService) -> bool:
+        return llm_service.get_status() in (LlmStatus.READY, LlmStatus.INIT_FAILED)
+
+    def __get_used_npu_memory(self, starting: LlmService) -> int:
+        # Only models with a process are on the npu (not the ones waiting for their tokenizer or restart)
+        return sum(self.__get_npu_memory(llm_service) for llm_service in self.name_to_llm_services.values()
+            if llm_service is not starting and llm_service.get_status() != LlmStatus.IDLE and llm_service.process is not None)
+
+    def __get_npu_memory(self, llm_service: LlmService) -> int:
+        return int(self.replica_descriptors[llm_service.replica_name].get("npu_memory_mb", 0))
+
+    # ---------------------------------------------
+    #               MODEL-DESCRIPTORS RELOAD
+    # ---------------------------------------------
+    async def watch_model_descriptors(self):
+        """
+        Reloads the model-descriptors as soon as the file was changed
+        """
+        if MODEL_DESCRIPTORS_CHECK_INTERVAL_SECONDS <= 0:
+            return
+        while True:
+            await asyncio.sleep(MODEL_DESCRIPTORS_CHECK_INTERVAL_SECONDS)
+            try:
+                if os.stat(MODEL_DESCRIPTORS_PATH).st_mtime != self.model_descriptors_mtime:
+                    logger.info("Model-descriptors changed, reloading them")
+                    await self.reload_llm_services()
+            except Exception as e:
+                logger.error(f"Error while reloading the model-descriptors! {repr(e)}")
+
+    async def reload_llm_services(self) -> dict:
+        """
+        Reads the model-descriptors again. Models which were removed or changed are stopped (once their queued prompts
+        are answered) and removed, models which were added or changed are created (and started if they should run
+        on startup). The other models are left alone. Returns the names of the models by kind of change
+        """
+        async with self.reload_lock:
+            model_descriptors = self.__read_model_descriptors()
+            changes = self.__diff_model_descriptors(model_descriptors)
+            tokenizer_ips = self.__get_tokenizer_ips(self.model_descriptors + model_descriptors)
+            reloaded = [model_desc for model_desc in model_descriptors
+                if model_desc["model_name"] in changes["added"] + changes["changed"]]
+            # Everything which may fail is done before the models in use are touched
+            created = []
+            try:
+                for model_desc in reloaded:
+                    created.append(self.__create_llm_router(model_desc))
+            except Exception:
+                self.__discard_llm_services([llm_service for router, _ in created for llm_service in router.replicas])
+                raise
+            # The replicas of a changed model are swapped at once: new prompts go to the new replicas right away, the
+            # old ones answer their queued prompts. Only removed models are not found anymore
+            retired_routers = [self.name_to_llm_routers.pop(model_name, None) for model_name in changes["removed"] + changes["changed"]]
+            retired_routers = [router for router in retired_routers if router is not None]
+            for router in retired_routers:
+                for llm_service in router.replicas:
+                    self.name_to_llm_services.pop(llm_service.replica_name, None)
+            self.model_descriptors = model_descriptors
+            self.tags = None
+            for router, replica_descriptors in created:
+                self.__add_llm_router(router, replica_descriptors)
+                for llm_service in router.replicas:
+                    self.pending_starts[llm_service] = asyncio.Event()
+            try:
+                # Prompts for the new replicas wait until the old ones are off the npu. One which fails to stop must
+                # not keep the others running
+                for router in retired_routers:
+                    try:
+                        await self.__retire_llm_services(router)
+                    except Exception as e:
+                        logger.error(f"Error while removing model '{router.model_name}'! {repr(e)}")
+                await self.__reload_tokenizer_services(tokenizer_ips)
+            finally:
+                self.reload_startup_task = asyncio.create_task(self.__start_reloaded_llm_services(reloaded))
+            logger.info(f"Reloaded model-descriptors: {changes}")
+            return changes
+
+    async def __start_reloaded_llm_services(self, model_descriptors: list[dict]):
+        # The models which run on startup are started in the background, prompts for them wait until they're started.
+        # The other ones may be started on demand right away
+        startup_descriptors = [model_desc for model_desc in model_descriptors if model_desc["run_on_startup"].lower() == "true"]
+        for model_desc in model_descriptors:
+            if model_desc not in startup_descriptors:
+                self.__allow_start(model_desc["model_name"])
+        try:
+            await self.start_default_llm_services(startup_descriptors)
+        finally:
+            for model_desc in startup_descriptors:
+                self.__allow_start(model_desc["model_name"])
+
+    def __allow_start(self, model_name: str):
+        router = self.name_to_llm_routers.get(model_name)
+        for llm_service in router.replicas if router is not None else []:
+            pending_start = self.pending_starts.pop(llm_service, None)
+            if pending_start is not None:
+                pending_start.set()
+
+    def reload_tokenizer_services(self) -> dict:
+        """
+        Reads the model-descriptors again. Tokenizers of models which were removed or changed are stopped and removed,
+        the ones of models which were added or changed are created (they're started by the llm-service)
+        """
+        model_descriptors = self.__read_model_descriptors()
+        changes = self.__diff_model_descriptors(model_descriptors)
+        for model_name in changes["removed"] + changes["changed"]:
+            for replica_name in self.__get_replica_names(model_name):
+                logger.info(f"Removing tokenizer-service for model '{replica_name}'")
+                tokenizer_service = self.name_to_tokenizer_services.pop(replica_name, None)
+                if tokenizer_service is not None:
+                    tokenizer_service.users.discard(replica_name)
+                    # Other models may still use it
+                    if not tokenizer_service.users:
+                        tokenizer_service.stop_tokenizer()
+                self.replica_descriptors.pop(replica_name, None)
+        self.model_descriptors = model_descriptors
+        for model_desc in model_descriptors:
+            if model_desc["model_name"] in changes["added"] + changes["changed"]:
+                self.__create_tokenizer_services(model_desc)
+        logger.info(f"Reloaded model-descriptors: {changes}")
+        return changes
+
+    def __diff_model_descriptors(self, model_descriptors: list[dict]) -> dict:
+        old_descriptors = {model_desc["model_name"]: model_desc for model_desc in self.model_descriptors or []}
+        new_descriptors = {model_desc["model_name"]: model_desc for model_desc in model_descriptors}
+        changes = {"added": [], "removed": [], "changed": [], "unchanged": []}
+        for model_name, model_desc in new_descriptors.items():
+            if model_name not in old_descriptors:
+                changes["added"].append(model_name)
+            elif model_desc != old_descriptors[model_name]:
+                changes["changed"].append(model_name)
+            else:
+                changes["unchanged"].append(model_name)
+        changes["removed"] = [model_name for model_name in old_descriptors if model_name not in new_descriptors]
+        return changes
+
+    async def __retire_llm_services(self, router: LlmRouter):
+        # New prompts don't reach the replicas anymore, the queued ones are answered before the replicas are stopped
+        for llm_service in router.replicas:
+            deadline = time.monotonic() + SWAP_TIME_OUT_SECONDS
+            while not llm_service.scheduler.try_acquire():
+                if time.monotonic() > deadline:
+                    logger.warning(f"Model '{llm_service.replica_name}' is still busy, stopping it anyway")
+                    break
+                await asyncio.sleep(SWAP_RETRY_INTERVAL_SECONDS)
+            async with self.swap_lock:
+                await self.__stop_llm_service(llm_service)
+            # A replica of the changed model with the same name takes over its metrics
+            replaced = llm_service.replica_name in self.name_to_llm_services
+            llm_service.metrics.unregister(remove_values=not replaced)
+            if not replaced:
+                self.replica_descriptors.pop(llm_service.replica_name, None)
+            logger.info(f"Removed llm-service for model '{llm_service.replica_name}'")
+
+    def __get_tokenizer_ips(self, model_descriptors: list[dict]) -> set[str]:
+        return {replica_desc["tokenizer_ip"] for model_desc in model_descriptors
+            for _, replica_desc in self.__get_replica_descriptors(model_desc)}
+
+    async def __reload_tokenizer_services(self, tokenizer_ips: set[str]):
+        # Tokenizers of changed models may have to be restarted before the models are
+        for tokenizer_ip in tokenizer_ips:
+            try:
+                await asyncio.to_thread(tokenizer_session.post, TOKENIZER_RELOAD_API.format(tokenizer_ip),
+                    timeout=TOKENIZER_REQUEST_TIME_OUT_SECONDS)
+            except Exception as e:
+                logger.warning(f"Could not reload the tokenizer-service at {tokenizer_ip}! {repr(e)}")
+
+    def __get_replica_names(self, model_name: str) -> list[str]:
+        return [replica_name for replica_name in self.replica_descriptors
+            if replica_name == model_name or replica_name.startswith(f"{model_name}@")]
 
     def get_model_descriptors(self):
         return list(self.model_descriptors)
 
+    def get_tags(self) -> dict:
+        if self.tags is None:
+            self.tags = {"models": self.get_model_descriptors()}
+        return self.tags
+
     def get_llmservice(self, model_name: str) -> LlmService:
+        """
+        Returns the llm-service of the given replica (the name of a model stands for its first replica)
+        """
         if model_name in self.name_to_llm_services:
             return self.name_to_llm_services[model_name]
         raise Exception(f"No model found for name '{model_name}'!")
 
+    def get_llmrouter(self, model_name: str) -> LlmRouter:
+        if model_name in self.name_to_llm_routers:
+            return self.name_to_llm_routers[model_name]
+        raise Exception(f"No model found for name '{model_name}'!")
+
+    def get_tokenizerservices(self) -> dict[str, TokenizerService]:
+        return dict(self.name_to_tokenizer_services)
+
     def get_tokenizerservice(self, model_name: str) -> TokenizerService:
+        # Models added since the model-descriptors were read are only known after a reload (see /reload)
         if model_name in self.name_to_tokenizer_services:
             return self.name_to_tokenizer_services[model_name]
         raise Exception(f"No tokenizer found for name '{model_name}'!")
@@ -1,7 +1,11 @@
 from fastapi import FastAPI, HTTPException
+from fastapi.responses import JSONResponse
 from pydantic import BaseModel
 from modelhelper import ModelHelper
-from tokenizerservice import TokenizerService
+from tokenizerservice import TokenizerService, TokenizerStatus
+
+# Max. time a long-poll for a status waits
+MAX_STATUS_WAIT_SECONDS = 60
 
 app = FastAPI(title="Tokenizer Service")
 
@@ -26,12 +30,62 @@ def start_tokenizer(req: StartTokenizerRequest):
     except Exception as e:
         raise HTTPException(500, str(e))
 
+@app.post("/reload")
+def reload():
+    """
+    Reads the model-descriptors again (called by the llm-service when they changed). Tokenizers of removed or
+    changed models are stopped
+    """
+    try:
+        return model_helper.reload_tokenizer_services()
+    except Exception as e:
+        raise HTTPException(500, str(e))
+
 @app.get("/status/{tokenizer_name}")
 def status(tokenizer_name):
     """
-    Reports whether the tokenizer process is alive.
+    Reports whether the tokenizer process is alive and the port it listens at (which is the one of another model
+    if the tokenizer is shared)
     """
-    tokenizer_service = model_helper.get_tokenizerservice(tokenizer_name)
+    tokenizer_service = get_tokenizerservice(tokenizer_name)
     return {
-        "status": tokenizer_service.get_status()
+        "status": tokenizer_service.get_status(),
+        "port": tokenizer_service.port,
+        "restarts": tokenizer_service.restart_count
     }
+
+# The readiness checks are async, so they don't wait for a free worker thread while long-polls occupy them
+@app.get("/ready")
+async def ready():
+    """
+    Readiness check without any waiting: 200 if every tokenizer which was started is ready (resp. there is none), 503 otherwise
+    """
+    tokenizers = {name: tokenizer_service.is_ready() for name, tokenizer_service in model_helper.get_tokenizerservices().items()
+        if not tokenizer_service.stopped}
+    return JSONResponse({"ready": all(tokenizers.values()), "tokenizers": tokenizers}, 200 if all(tokenizers.values()) else 503)
+
+@app.get("/ready/{tokenizer_name}")
+async def ready_tokenizer(tokenizer_name):
+    """
+    Readiness check of one tokenizer without any waiting: 200 if it's ready, 503 otherwise
+    """
+    tokenizer_service = get_tokenizerservice(tokenizer_name)
+    is_ready = tokenizer_service.is_ready()
+    return JSONResponse({"ready": is_ready}, 200 if is_ready else 503)
+
+@app.get("/status/{tokenizer_name}/wait")
+def await_status(tokenizer_name, status: int = TokenizerStatus.READY.value, timeout: float = 30):
+    """
+    Long-poll: reports the status of the tokenizer as soon as it has the given status (READY by default),
+    or the current status after the timeout
+    """
+    tokenizer_service = get_tokenizerservice(tokenizer_name)
+    return {
+        "status": tokenizer_service.await_status(TokenizerStatus(status), min(timeout, MAX_STATUS_WAIT_SECONDS))
+    }
+
+def get_tokenizerservice(tokenizer_name: str) -> TokenizerService:
+    try:
+        return model_helper.get_tokenizerservice(tokenizer_name)
+    except Exception as e:
+        raise HTTPException(404, str(e))
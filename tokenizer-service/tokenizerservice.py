@@ -1,9 +1,10 @@
 import logging
 import re
+import socket
 import subprocess
 import threading
+import time
 from enum import Enum
-from fastapi import HTTPException
 from time import sleep
 
 
@@ -17,29 +18,64 @@ logger.setLevel(logging.DEBUG)
 
 # Actual I'd expect "Server running at" but somehow that's not printed although tokenizer server is ready
 TOKENIZER_READY_PATTERN = re.compile("(.*)(Models won't be available and only tokenizers)(.*)")
+# After the ready line, the tokenizer port is probed until it accepts connections
+TOKENIZER_PROBE_TIME_OUT_SECONDS = 30
+TOKENIZER_PROBE_INTERVAL_SECONDS = 0.05
+# Time the tokenizer gets to exit after being terminated, before it's killed
+TOKENIZER_STOP_TIME_OUT_SECONDS = 10
+# A crashed tokenizer is restarted after 1, 2, 4.. seconds, but at most after that many seconds
+RESTART_BACKOFF_BASE_SECONDS = 1
+RESTART_BACKOFF_MAX_SECONDS = 60
+# A tokenizer which was up for that long before it crashed is considered stable, so its restarts start from scratch
+RESTART_RESET_SECONDS = 300
 
+# One tokenizer process. Models (resp. their replicas) whose tokenizer files are the same share it, it's stopped once
+# no model uses it anymore. If the process dies, it's restarted with an exponential backoff
 class TokenizerService:
     def __handle_tokenizer_output(self, pipe, tag):
         for line in pipe:
             line = line.rstrip("\n")
             logger.debug(f"Msg from tokenizer: '{line}' and tag '{tag}'")
             if TOKENIZER_READY_PATTERN.match(line) != None:
-                # Wait for another 2 seconds to make sure the tokenizer is ready as soon as the llm tries to connect
-                sleep(1.5)
-                self.status = TokenizerStatus.READY
+                # Make sure the tokenizer accepts connections as soon as the llm tries to connect
+                self.__await_port_open()
+                self.__change_status(TokenizerStatus.READY)
                 logger.info(f"Tokenizer '{self.tokenizer_path}' ready!")
 
-    def __init__(self, tokenizer_py: str, tokenizer_path: str, port: int):
+    def __await_port_open(self):
+        deadline = time.monotonic() + TOKENIZER_PROBE_TIME_OUT_SECONDS
+        while time.monotonic() < deadline:
+            try:
+                with socket.create_connection(("127.0.0.1", self.port), timeout=TOKENIZER_PROBE_INTERVAL_SECONDS):
+                    return
+            except OSError:
+                sleep(TOKENIZER_PROBE_INTERVAL_SECONDS)
+        logger.error(f"Tokenizer '{self.tokenizer_path}' does not accept connections at port {self.port}!")
+
+    def __init__(self, tokenizer_py: str, tokenizer_path: str, port: int, shared: bool = True):
         self.status = TokenizerStatus.IDLE
+        self.status_changed = threading.Condition()
         self.process = None
+        # Guards starting, stopping and restarting the process
+        self.process_lock = threading.Lock()
         self.tokenizer_py = tokenizer_py
         self.port = port
         self.tokenizer_path = tokenizer_path
+        # Whether other models with the same tokenizer files may use this tokenizer
+        self.shared = shared
+        # Names of the models (replicas) using this tokenizer
+        self.users = set()
+        # Set while the tokenizer should not run (not started yet or stopped), so it's not restarted
+        self.stopped = True
+        self.started_at = None
+        self.restart_count = 0
+        self.consecutive_restarts = 0
         logger.debug(f"Tokenizer {tokenizer_path}/{tokenizer_py} at port {self.port} created..")
 
     def __start_tokenizer_internal(self):
+        # Only called while holding the process lock
         logger.info(f"Starting tokenizer {self.tokenizer_path}/{self.tokenizer_py} at port {self.port}")
-        self.status = TokenizerStatus.INIT
+        self.__change_status(TokenizerStatus.INIT)
         self.process = subprocess.Popen(
             ["python3", self.tokenizer_py, "--port", str(self.port)], cwd=self.tokenizer_path,
             stdin=subprocess.PIPE,
@@ -49,16 +85,83 @@ class TokenizerService:
             bufsize=1
         )
         logger.debug(f"Tokenizer started, got process {self.process}..")
+        self.started_at = time.monotonic()
 
         # Handle stdout and stderr in threads
         threading.Thread(target=self.__handle_tokenizer_output, args=(self.process.stdout, "STDOUT",), daemon=True).start()
         threading.Thread(target=self.__handle_tokenizer_output, args=(self.process.stderr, "STDERR",), daemon=True).start()
+        threading.Thread(target=self.__supervise, args=(self.process,), daemon=True).start()
 
     def start_tokenizer(self) -> str:
-        if self.status != TokenizerStatus.IDLE:
-            raise HTTPException(status_code=500, detail=f"Tokenizer already started!")
-        self.__start_tokenizer_internal()
+        """
+        Starts the tokenizer, unless it's already running (e.g. for another model sharing it) or about to be restarted
+        """
+        with self.process_lock:
+            self.stopped = False
+            if self.process is not None:
+                return "already started"
+            self.__start_tokenizer_internal()
         return "ok"
 
+    def stop_tokenizer(self):
+        with self.process_lock:
+            self.stopped = True
+            process = self.process
+            self.process = None
+        if process is None:
+            return
+        logger.info(f"Stopping tokenizer {self.tokenizer_path}/{self.tokenizer_py} at port {self.port}")
+        process.terminate()
+        try:
+            process.wait(timeout=TOKENIZER_STOP_TIME_OUT_SECONDS)
+        except subprocess.TimeoutExpired:
+            process.kill()
+            process.wait()
+        self.__change_status(TokenizerStatus.IDLE)
+
+    def __supervise(self, process: subprocess.Popen):
+        """
+        Waits until the given tokenizer process exits. Unless it was stopped, it's restarted after a backoff.
+        Until then its status is IDLE, so models don't connect to a dead tokenizer
+        """
+        return_code = process.wait()
+        with self.process_lock:
+            if self.process is not process:
+                # Stopped on purpose
+                return
+            self.process = None
+        logger.error(f"Tokenizer {self.tokenizer_path}/{self.tokenizer_py} at port {self.port} exited unexpectedly with code {return_code}")
+        self.__change_status(TokenizerStatus.IDLE)
+        if time.monotonic() - self.started_at > RESTART_RESET_SECONDS:
+            self.consecutive_restarts = 0
+        backoff = min(RESTART_BACKOFF_BASE_SECONDS * 2 ** self.consecutive_restarts, RESTART_BACKOFF_MAX_SECONDS)
+        self.consecutive_restarts += 1
+        logger.info(f"Restarting tokenizer at port {self.port} in {backoff}s (attempt {self.consecutive_restarts})")
+        sleep(backoff)
+        with self.process_lock:
+            # Stopped or started by a model in the meantime
+            if self.stopped or self.process is not None:
+                return
+            self.restart_count += 1
+            self.__start_tokenizer_internal()
+
     def get_status(self) -> TokenizerStatus:
         return self.status
+
+    def is_ready(self) -> bool:
+        # Ready and the process is still alive (its exit may not have been noticed yet)
+        process = self.process
+        return self.status == TokenizerStatus.READY and process is not None and process.poll() is None
+
+    def await_status(self, status: TokenizerStatus, timeout: float) -> TokenizerStatus:
+        """
+        Blocks until the tokenizer has the given status or the timeout is over. Returns the current status
+        """
+        with self.status_changed:
+            self.status_changed.wait_for(lambda: self.status == status, timeout=timeout)
+            return self.status
+
+    def __change_status(self, new_status: TokenizerStatus):
+        with self.status_changed:
+            self.status = new_status
+            self.status_changed.notify_all()